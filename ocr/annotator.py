@@ -1,24 +1,34 @@
 import cv2
 
+from ocr.crop_atlas import CropAtlas, list_crops
+from ocr.crop_hashes import update_hash_index, group_similar_runs
 from ocr.data_processor import DataProcessor
+from ocr.timer_anomalies import build_review_queue
 from ocr.ui_renderer import UIRenderer
 
 
 class OCRTimerAnnotator:
-    def __init__(self, img_dir, preds_path, output_path, canvas_size=(1920,1080), temp_path=None):
-        self.data = DataProcessor(img_dir, preds_path)
+    def __init__(self, img_dir, preds_path, output_path, canvas_size=(1920,1080), temp_path=None, atlas_dir=None):
+        atlas = CropAtlas.open(img_dir, atlas_dir) if atlas_dir is not None else None
+        self.data = DataProcessor(img_dir, preds_path, atlas=atlas)
         window_name = 'Manual OCR Annotating'
         self.ui_renderer = UIRenderer(window_name, canvas_size)
         self.output_path = output_path
         self.temp_path = temp_path
         self.prev_text = ''
 
+        # Grid mode (batch annotating of a page of frames):
+        self.grid_mode = False
+        self.grid_anchor = None     # the first frame of the selected range
+        self.grid_input = ''        # the text typed for the selection
+
         print('Data loaded. Total frames: {}'.format(len(self.data)))
 
     def run(self):
         ''' Main loop '''
         num_data = len(self.data)
         self.ui_renderer.create_window(self.mouse_handler, self.trackbar_handler, num_data, window_size=(600, 600))
+        self.ui_renderer.set_trackbar(self.data.cur_idx)
         self.ui_renderer.text_layer.select_cell(0)
         running = True
 
@@ -34,6 +44,9 @@ class OCRTimerAnnotator:
         del self.ui_renderer
 
     def process_frame(self):
+        if self.grid_mode:
+            return self.process_grid()
+
         self.ui_renderer.render(self.data.get_frame())
 
         while True:
@@ -64,7 +77,9 @@ class OCRTimerAnnotator:
                 self.data.clean_text()
                 break
             elif key == ord('s'):   # save -> clean text
-                self.save()
+                # (the text is applied to the whole group of the frame before saving)
+                self.data.save_frame(self.temp_path)
+                self.save(wait=False)
                 print('Data has been saved to {}!'.format(self.output_path))
                 self.ui_renderer.render(self.data.get_frame())
                 break
@@ -95,14 +110,103 @@ class OCRTimerAnnotator:
                 if len(self.prev_text) > 0:
                     self.data.set_text(self.prev_text)
                 break
+            elif key == ord('g'):   # g -> switch to the grid mode
+                self.data.save_frame(self.temp_path)
+                self.grid_mode = True
+                break
 
         return True
 
-    def save(self, dst_path=None):
+    def process_grid(self):
+        self.render_grid()
+
+        while True:
+            if self.ui_renderer.is_window_visible() == False:
+                return False
+
+            key = cv2.waitKey(10)
+
+            if key == 27: # Esc -> termination
+                return False
+            elif key == ord('g'):   # g -> switch back to the single frame mode
+                self.grid_mode = False
+                self.grid_anchor = None
+                self.grid_input = ''
+                self.ui_renderer.text_layer.select_cell(0)
+                break
+            elif key == 32:  # Space -> next frame
+                self.ui_renderer.set_trackbar(self.data.next())
+                break
+            elif key == 8:  # Backspace -> previous frame
+                self.ui_renderer.set_trackbar(self.data.prev())
+                break
+            elif key == ord(']'):    # ] -> next page
+                num_cells = self.ui_renderer.grid_layer.num_cells
+                self.ui_renderer.set_trackbar(self.data.set_frame_idx(self.data.cur_idx + num_cells))
+                break
+            elif key == ord('['):    # [ -> previous page
+                num_cells = self.ui_renderer.grid_layer.num_cells
+                self.ui_renderer.set_trackbar(self.data.set_frame_idx(self.data.cur_idx - num_cells))
+                break
+            elif key == ord('r'):   # r -> start / cancel selecting a range of frames
+                self.grid_anchor = self.data.cur_idx if self.grid_anchor is None else None
+                break
+            elif key >= ord('0') and key <= ord('9') or key == ord('.'):
+                if len(self.grid_input) < self.data.max_text_len:
+                    self.grid_input += chr(key)
+                break
+            elif key == ord('c'):   # c -> remove the last typed char
+                self.grid_input = self.grid_input[:-1]
+                break
+            elif key == 13:  # Enter -> set the typed text to the selected frames
+                if len(self.grid_input) > 0:
+                    self.set_text_to_selection(self.grid_input)
+                    self.grid_input = ''
+                break
+            elif key == ord('e'):   # e -> copy text from the frame preceding the selection
+                first, _ = self.get_grid_selection()
+                if first > 0:
+                    self.set_text_to_selection(self.data.get_text(first - 1))
+                break
+            elif key == ord('s'):   # save
+                self.data.save_frame(self.temp_path)
+                self.save(wait=False)
+                print('Data has been saved to {}!'.format(self.output_path))
+                break
+
+        return True
+
+    def get_grid_selection(self):
+        if self.grid_anchor is None:
+            return self.data.cur_idx, self.data.cur_idx
+        return min(self.grid_anchor, self.data.cur_idx), max(self.grid_anchor, self.data.cur_idx)
+
+    def set_text_to_selection(self, text):
+        first, last = self.get_grid_selection()
+        for idx in range(first, last + 1):
+            self.data.set_text(text, idx)
+            self.data.save_frame(self.temp_path, idx)
+        self.prev_text = text
+        self.grid_anchor = None
+
+        # Go to the frame following the selection:
+        self.ui_renderer.set_trackbar(self.data.set_frame_idx(last + 1))
+
+    def render_grid(self):
+        num_cells = self.ui_renderer.grid_layer.num_cells
+        page_start = (self.data.cur_idx // num_cells) * num_cells
+        page_end = min(page_start + num_cells, len(self.data))
+        frames = [self.data.get_frame(idx) for idx in range(page_start, page_end)]
+        status = '{}-{}/{}  Text: {}'.format(page_start + 1, page_end, len(self.data), self.grid_input)
+        if self.grid_anchor is not None:
+            status += '  (range)'
+        self.ui_renderer.render_grid(frames, page_start, self.data.cur_idx, self.get_grid_selection(), status)
+
+    def save(self, dst_path=None, wait=True):
         if dst_path is None:
             dst_path = self.output_path
         if self.data:
-            self.data.save(dst_path)
+            self.data.save(dst_path, wait)
 
     def load(self, path):
         assert self.data is not None
@@ -112,10 +216,40 @@ class OCRTimerAnnotator:
         assert self.data is not None
         self.data.restore(path)
 
+    def close(self):
+        if self.data:
+            self.data.close()
+
+    def review_anomalies(self, max_step=None):
+        '''
+        Makes the navigation walk only the frames which texts are inconsistent with the timer countdown
+        (the most suspicious first)
+        '''
+        texts = [frame.text for frame in self.data.frames]
+        indices, _ = build_review_queue(texts, max_step=max_step)
+        self.data.set_queue(indices)
+
+        return len(indices)
+
+    def group_similar_crops(self, img_dir, index_path, max_distance=0):
+        '''
+        Groups runs of consecutive near-identical crops (by their perceptual hashes),
+        so that a text entered for a frame is applied to the whole group
+        '''
+        names = list_crops(img_dir)
+        assert len(names) == len(self.data)
+        hashes = update_hash_index(img_dir, names, index_path)
+        group_ids = group_similar_runs(hashes, max_distance)
+        self.data.set_groups(group_ids)
+
+        return int(group_ids[-1]) + 1 if len(group_ids) else 0
+
 
     ''' Handler functions '''
     def mouse_handler(self, event, x, y, flags, param):
-        if event == cv2.EVENT_LBUTTONUP:
+        if event == cv2.EVENT_LBUTTONUP and self.grid_mode:
+            self.grid_click_handler(x, y, flags)
+        elif event == cv2.EVENT_LBUTTONUP:
             self.mouse_left_click_handler(x, y)
         elif event == cv2.EVENT_RBUTTONUP:
             self.mouse_right_click_handler(x, y)
@@ -130,7 +264,7 @@ class OCRTimerAnnotator:
         # TextEditor layer:
         if self.check_hit(x, y, self.ui_renderer.text_layer_pos):
             x, y = self.normalize_coords(x, y, self.ui_renderer.text_layer_pos)
-            h, w = self.ui_renderer.text_layer.canvas.shape[0:2]
+            w, h = self.ui_renderer.text_layer.size
             x, y = int(round(x*w)), int(round(y*h))
             cell_idx = self.determine_box_by_coords(x, y, self.ui_renderer.text_layer.cell_boxes)
             self.ui_renderer.text_layer.select_cell(cell_idx)
@@ -140,10 +274,31 @@ class OCRTimerAnnotator:
     def mouse_right_click_handler(self, x, y):
         pass
 
+    def grid_click_handler(self, x, y, flags):
+        '''
+        Selects the clicked frame, or a range of frames from the current one when Shift is held
+        '''
+        if self.check_hit(x, y, self.ui_renderer.grid_layer_pos):
+            cell_idx = self.ui_renderer.grid_layer.get_cell_idx(x, y)
+            num_cells = self.ui_renderer.grid_layer.num_cells
+            idx = (self.data.cur_idx // num_cells) * num_cells + cell_idx
+            if cell_idx >= 0 and idx < len(self.data):
+                if flags & cv2.EVENT_FLAG_SHIFTKEY:
+                    if self.grid_anchor is None:
+                        self.grid_anchor = self.data.cur_idx
+                else:
+                    self.grid_anchor = None
+                self.ui_renderer.set_trackbar(self.data.set_frame_idx(idx))
+
+        self.render_grid()
+
     def trackbar_handler(self, value):
         self.data.save_frame(self.temp_path)
         self.data.set_frame_idx(value-1)
-        self.ui_renderer.render(self.data.get_frame())
+        if self.grid_mode:
+            self.render_grid()
+        else:
+            self.ui_renderer.render(self.data.get_frame())
 
     @staticmethod
     def check_hit(x, y, box):
@@ -0,0 +1,169 @@
+import os
+import cv2
+import json
+import hashlib
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+ATLAS_DATA_NAME = 'atlas.bin'
+ATLAS_INDEX_NAME = 'atlas.json'
+ATLAS_VERSION = 2
+DEFAULT_ATLAS_WIDTH = None  # the crops are stored at their native size (the UI resizes them on draw)
+
+
+def list_crops(img_dir):
+    ''' Returns sorted names of the crops (the same order the OCR DataProcessor uses) '''
+    return sorted(file for file in os.listdir(img_dir) if not file.endswith('.'))
+
+
+def get_source_signature(img_dir, names):
+    ''' Fingerprint of the source directory based on the names, sizes and modification times of the crops '''
+    sha = hashlib.sha1()
+    for name in names:
+        stat = os.stat(os.path.join(img_dir, name))
+        sha.update('{}:{}:{}\n'.format(name, stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+
+    return sha.hexdigest()
+
+
+def resize_crop(img, width):
+    ''' Resizes the crop to the given width keeping the aspect ratio (None - keeps the native size) '''
+    img_h, img_w = img.shape[0:2]
+    if width is not None and img_w != width:
+        inter = cv2.INTER_AREA if img_w > width else cv2.INTER_CUBIC
+        img = cv2.resize(img, (width, int(round(img_h * width / img_w))), interpolation=inter)
+
+    return img
+
+
+def load_crop(path, width):
+    ''' Reads the crop and resizes it to the given width keeping the aspect ratio (see resize_crop()) '''
+    img = cv2.imread(path, cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+
+    return resize_crop(img, width)
+
+
+def write_atlas(atlas_dir, names, imgs, width, signature):
+    '''
+    Writes the crops (an iterable in the order of names, None for unreadable crops, resized to width
+    if it's not None) one after another into a single uint8 file with a json index of their offsets
+    and shapes
+    '''
+    if not os.path.exists(atlas_dir):
+        os.makedirs(atlas_dir)
+    data_path = os.path.join(atlas_dir, ATLAS_DATA_NAME)
+    index_path = os.path.join(atlas_dir, ATLAS_INDEX_NAME)
+
+    offsets, shapes = [], []
+    size = 0
+    with open(data_path + '.tmp', 'wb') as file:
+        for name, img in zip(names, imgs):
+            if img is None:
+                print('Cannot read \'{}\''.format(name))
+                offsets.append(size)
+                shapes.append([0, 0])
+                continue
+            assert (width is None or img.shape[1] == width) and img.ndim == 3
+            file.write(np.ascontiguousarray(img).tobytes())
+            offsets.append(size)
+            shapes.append(list(img.shape[0:2]))
+            size += img.size
+
+    index = {
+        'version': ATLAS_VERSION,
+        'signature': signature,
+        'width': width,
+        'size': size,
+        'names': names,
+        'offsets': offsets,
+        'shapes': shapes
+    }
+    with open(index_path + '.tmp', 'w') as file:
+        json.dump(index, file)
+    os.replace(data_path + '.tmp', data_path)
+    os.replace(index_path + '.tmp', index_path)
+
+
+def pack_atlas(img_dir, atlas_dir, width=DEFAULT_ATLAS_WIDTH, num_workers=None):
+    '''
+    Decodes all the crops in parallel, resizes them to width (if it's not None) and writes them into the atlas
+    '''
+    names = list_crops(img_dir)
+    signature = get_source_signature(img_dir, names)
+    paths = [os.path.join(img_dir, name) for name in names]
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        write_atlas(atlas_dir, names, pool.map(lambda p: load_crop(p, width), paths), width, signature)
+
+    print('Packed {} crops to {} ({:.1f} MB)'.format(
+        len(names), atlas_dir, os.path.getsize(os.path.join(atlas_dir, ATLAS_DATA_NAME)) / 1e6))
+
+
+class CropAtlas:
+    ''' Read-only memory-mapped storage of the crops '''
+
+    def __init__(self, atlas_dir):
+        with open(os.path.join(atlas_dir, ATLAS_INDEX_NAME), 'r') as file:
+            index = json.load(file)
+        self.version = index.get('version')
+        self.signature = index['signature']
+        self.width = index['width']
+        self.offsets = index.get('offsets', [])
+        self.shapes = index.get('shapes', [])
+        self.name_to_idx_map = {name: idx for idx, name in enumerate(index['names'])}
+
+        self.data = None
+        if self.version == ATLAS_VERSION and index['size'] > 0:
+            self.data = np.memmap(os.path.join(atlas_dir, ATLAS_DATA_NAME), dtype=np.uint8, mode='r',
+                                  shape=(index['size'],))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, name):
+        return name in self.name_to_idx_map
+
+    def get(self, name):
+        ''' Returns the crop as a read-only view of the atlas (without copying) '''
+        idx = self.name_to_idx_map.get(name)
+        if idx is None or self.data is None or self.shapes[idx][0] == 0:
+            return None
+        h, w = self.shapes[idx]
+        start = self.offsets[idx]
+
+        return self.data[start:start + h * w * 3].reshape(h, w, 3)
+
+    @staticmethod
+    def open(img_dir, atlas_dir, width=DEFAULT_ATLAS_WIDTH, num_workers=None):
+        ''' Opens the atlas of the crops (re)building it if the source directory has changed '''
+        index_path = os.path.join(atlas_dir, ATLAS_INDEX_NAME)
+        if os.path.isfile(index_path):
+            atlas = CropAtlas(atlas_dir)
+            if atlas.version == ATLAS_VERSION and atlas.width == width and \
+                    atlas.signature == get_source_signature(img_dir, list_crops(img_dir)):
+                return atlas
+            del atlas
+
+        print('Packing the crops from {}...'.format(img_dir))
+        pack_atlas(img_dir, atlas_dir, width, num_workers)
+
+        return CropAtlas(atlas_dir)
+
+
+def get_args():
+    parser = argparse.ArgumentParser('Packs timer crops into a memory-mapped atlas for the OCR tool')
+    parser.add_argument('img_dir', help='Directory containing the crops')
+    parser.add_argument('atlas_dir', help='Directory where the atlas will be saved to')
+    parser.add_argument('--width', type=int, default=DEFAULT_ATLAS_WIDTH,
+                        help='Width the crops are resized to (the native size by default)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of decoding threads')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    pack_atlas(args.img_dir, args.atlas_dir, args.width, args.workers)
@@ -0,0 +1,110 @@
+import os
+import cv2
+import json
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+HASH_SIZE = (32, 8)     # the timer crops are wide, so the grid is too (256 bits)
+
+
+def average_hash(img, hash_size=HASH_SIZE):
+    '''
+    Average hash: the downscaled grayscale image thresholded by its mean value.
+    Returns the bits packed into a hex string
+    '''
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(img, hash_size, interpolation=cv2.INTER_AREA).astype(np.float32)
+    bits = (small > small.mean()).flatten()
+
+    return np.packbits(bits).tobytes().hex()
+
+
+def hash_crop(path):
+    img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None
+    return average_hash(img)
+
+
+def update_hash_index(img_dir, names, index_path, num_workers=None):
+    '''
+    Computes hashes of the crops (in parallel) and stores them in the json index.
+    Only the crops that are new or have changed since the previous run are hashed.
+    Returns the hashes in the order of names (None for unreadable crops)
+    '''
+    index = {}
+    if os.path.isfile(index_path):
+        with open(index_path, 'r') as file:
+            index = json.load(file)
+
+    stats = {}
+    to_hash = []
+    for name in names:
+        stat = os.stat(os.path.join(img_dir, name))
+        stats[name] = [stat.st_size, stat.st_mtime_ns]
+        entry = index.get(name)
+        if entry is None or entry[1:] != stats[name]:
+            to_hash.append(name)
+
+    if to_hash or len(index) != len(names):
+        paths = [os.path.join(img_dir, name) for name in to_hash]
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            for name, h in zip(to_hash, pool.map(hash_crop, paths)):
+                index[name] = [h] + stats[name]
+
+        # Remove the crops that no longer exist:
+        index = {name: index[name] for name in names}
+        index_dir = os.path.dirname(index_path)
+        if index_dir and not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        with open(index_path + '.tmp', 'w') as file:
+            json.dump(index, file)
+        os.replace(index_path + '.tmp', index_path)
+        if to_hash:
+            print('Hashed {} new crops'.format(len(to_hash)))
+
+    return [index[name][0] for name in names]
+
+
+def group_similar_runs(hashes, max_distance=0):
+    '''
+    Splits the sequence into runs of consecutive near-identical crops (the Hamming distance
+    between the hashes of neighbours is not greater than max_distance).
+    Returns the group id of every crop
+    '''
+    num = len(hashes)
+    if num == 0:
+        return np.zeros(0, dtype=np.int64)
+    valid = np.array([h is not None for h in hashes])
+    hash_len = max((len(h) // 2 for h in hashes if h is not None), default=0)
+    values = np.array([np.frombuffer(bytes.fromhex(h), dtype=np.uint8) if h is not None
+                       else np.zeros(hash_len, dtype=np.uint8) for h in hashes]).reshape(num, hash_len)
+
+    # Hamming distances between the neighbours:
+    diff = np.bitwise_xor(values[1:], values[:-1])
+    dist = np.unpackbits(diff, axis=1).sum(axis=1)
+    new_group = (dist > max_distance) | ~valid[1:] | ~valid[:-1]
+
+    return np.concatenate(([0], np.cumsum(new_group)))
+
+
+def get_args():
+    parser = argparse.ArgumentParser('Finds runs of near-identical timer crops')
+    parser.add_argument('img_dir', help='Directory containing the crops')
+    parser.add_argument('index_path', help='Json file where the hashes are stored')
+    parser.add_argument('--max_distance', type=int, default=0,
+                        help='Max Hamming distance between the hashes of near-identical crops')
+    parser.add_argument('--workers', type=int, default=None, help='Number of hashing threads')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    names = sorted(file for file in os.listdir(args.img_dir) if not file.endswith('.'))
+    hashes = update_hash_index(args.img_dir, names, args.index_path, args.workers)
+    groups = group_similar_runs(hashes, args.max_distance)
+    num_groups = int(groups[-1]) + 1 if len(groups) else 0
+    print('Crops: {}, groups: {}'.format(len(names), num_groups))
@@ -1,8 +1,15 @@
 import os
 import cv2
 import json
+import numpy as np
 from pathlib import PurePath
 
+from ui.async_writer import AsyncWriter
+
+
+DELTA_LOG_SUFFIX = '.log'   # frames saved since the last compaction of the annotation
+COMPACT_LOG_ENTRIES = 10000 # the delta log is merged into the annotation when it gets longer
+
 
 class DataProcessor:
     ''' Loads, prepares and manages data (images and points) '''
@@ -13,14 +20,17 @@ class DataProcessor:
             self.img_path = img_path
             self.img = None
             self.text = text
-            self.saved = True
+            self.saved = True       # written to the journal
+            self.dirty = True       # changed since the annotation was loaded / saved
 
         def set_text(self, text):
             self.text = text
             self.saved = False
+            self.dirty = True
 
-    def __init__(self, img_dir, preds_path, max_text_len=4):
+    def __init__(self, img_dir, preds_path, max_text_len=4, atlas=None):
         self. max_text_len = max_text_len
+        self.atlas = atlas
 
         # Parse image paths and read predictions json:
         self.frames = []
@@ -50,6 +60,20 @@ class DataProcessor:
         else:
             self.cur_idx = None
 
+        # Optional queue of frames to walk instead of all frames (e.g. the suspicious ones):
+        self.queue = None
+        self.queue_pos = 0
+        self.queue_pos_map = {}
+
+        # Optional groups of consecutive near-identical crops sharing the same text:
+        self.group_ids = None
+        self.group_starts = None
+
+        # Annotation file the frames have been loaded from / saved to (only the changes are saved to it):
+        self.base_path = None
+        self.num_log_entries = 0
+        self.writer = AsyncWriter()
+
     def __len__(self):
         return self.num_frames
 
@@ -68,7 +92,11 @@ class DataProcessor:
 
         frame = self.frames[idx]
         if frame.img is None:
-            frame.img = cv2.imread(frame.img_path, cv2.IMREAD_COLOR)
+            if self.atlas is not None:
+                # A view of the memory-mapped atlas, so it's not copied to RAM:
+                frame.img = self.atlas.get(PurePath(frame.img_path).parts[-1])
+            if frame.img is None:
+                frame.img = cv2.imread(frame.img_path, cv2.IMREAD_COLOR)
 
         return frame
 
@@ -133,9 +161,60 @@ class DataProcessor:
         elif self.cur_idx < 0:
             self.cur_idx = 0
 
+        if self.cur_idx in self.queue_pos_map:
+            self.queue_pos = self.queue_pos_map[self.cur_idx]
+
         return self.cur_idx
 
+    def set_queue(self, indices):
+        '''
+        Makes next() and prev() walk the given frames (in the given order) instead of all frames.
+        None or an empty queue walks all frames
+        '''
+        if indices is None or len(indices) == 0:
+            self.queue = None
+            self.queue_pos_map = {}
+            return
+        self.queue = [int(idx) for idx in indices]
+        self.queue_pos_map = {idx: pos for pos, idx in enumerate(self.queue)}
+        self.queue_pos = 0
+        self.cur_idx = self.queue[0]
+
+    def set_groups(self, group_ids):
+        '''
+        Sets the group of every frame (consecutive frames with the same id form a group).
+        A text set to a frame is applied to its whole group on saving the frame,
+        next() and prev() go to the first frame of the next / previous group
+        '''
+        if group_ids is None:
+            self.group_ids, self.group_starts = None, None
+            return
+        assert len(group_ids) == self.num_frames
+        self.group_ids = np.asarray(group_ids)
+        starts = np.flatnonzero(np.diff(self.group_ids, prepend=-1))
+        self.group_starts = np.append(starts, self.num_frames)
+
+    def get_group_range(self, idx=None):
+        ''' Returns the first and the last frames of the group '''
+        if idx is None:
+            idx = self.cur_idx
+        self._validate_frame_idx(idx)
+        if self.group_ids is None:
+            return idx, idx
+        group = self.group_ids[idx]
+
+        return int(self.group_starts[group]), int(self.group_starts[group + 1]) - 1
+
     def next(self):
+        if self.queue is not None:
+            self.queue_pos = min(self.queue_pos + 1, len(self.queue) - 1)
+            self.cur_idx = self.queue[self.queue_pos]
+            return self.cur_idx
+        if self.group_ids is not None:
+            _, last = self.get_group_range()
+            self.cur_idx = min(last + 1, self.num_frames - 1)
+            return self.cur_idx
+
         self.cur_idx += 1
         if self.cur_idx >= self.num_frames:
             self.cur_idx = self.num_frames - 1
@@ -143,22 +222,48 @@ class DataProcessor:
         return self.cur_idx
 
     def prev(self):
+        if self.queue is not None:
+            self.queue_pos = max(self.queue_pos - 1, 0)
+            self.cur_idx = self.queue[self.queue_pos]
+            return self.cur_idx
+        if self.group_ids is not None:
+            first, _ = self.get_group_range()
+            self.cur_idx = self.get_group_range(max(first - 1, 0))[0]
+            return self.cur_idx
+
         self.cur_idx -= 1
         if self.cur_idx < 0:
             self.cur_idx = 0
 
         return self.cur_idx
 
-    def save(self, dst_path):
-        output = {}
+    def save(self, dst_path, wait=True):
+        '''
+        Saves the annotation. If dst_path already contains the annotation loaded / saved in this session,
+        only the frames changed since then are appended to its delta log. The log is merged into dst_path
+        in the background when it exceeds COMPACT_LOG_ENTRIES and on close().
+        Otherwise the whole annotation is written
+        '''
+        if self.base_path == dst_path:
+            dirty = [idx for idx, frame in enumerate(self.frames) if frame.dirty]
+            if dirty:
+                self.writer.append(dst_path + DELTA_LOG_SUFFIX, self._dump_lines(dirty))
+                self.num_log_entries += len(dirty)
+                if self.num_log_entries >= COMPACT_LOG_ENTRIES:
+                    self.writer.call(compact_annotation, dst_path)
+                    self.num_log_entries = 0
+        else:
+            # Snapshot of the texts (the serialization is done in the writer thread):
+            names = [PurePath(frame.img_path).parts[-1] for frame in self.frames]
+            texts = [frame.text for frame in self.frames]
+            self.writer.call(write_annotation, dst_path, names, texts)
+            self.base_path = dst_path
+            self.num_log_entries = 0
         for frame in self.frames:
-            name = PurePath(frame.img_path).parts[-1]
-            # name = frame.img_path.split('/')[-1]
-            out = {'text': frame.text}
-            output[name] = out
+            frame.dirty = False
 
-        with open(dst_path, 'w') as file:
-            json.dump(output, file, indent=2)
+        if wait:
+            self.writer.flush()
 
     def save_frame(self, dst_path, idx=None):
         if idx is None:
@@ -168,30 +273,109 @@ class DataProcessor:
         frame = self.frames[idx]
 
         if not frame.saved:
-            output = {'text': frame.text}
-            name = PurePath(frame.img_path).parts[-1]
-            # name = frame.img_path.split('/')[-1]
-            with open(dst_path, 'a+') as file:
-                json.dump({name: output}, file)
-                file.write('\n')
-            frame.saved = True
+            # Apply the text to the whole group of near-identical crops:
+            first, last = self.get_group_range(idx)
+            for i in range(first, last + 1):
+                if i != idx:
+                    self.frames[i].set_text(frame.text)
+                self.frames[i].saved = True
+            self.writer.append(dst_path, self._dump_lines(range(first, last + 1)))
 
     def load(self, path):
+        '''
+        Merges the saved annotation (and its delta log if the compaction has not happened) into the frames
+        '''
         assert self.frames
-        loaded_frames = json.load(open(path, 'r'))
+        loaded = read_annotation(path)
+        self.num_log_entries = len(read_delta_log(path + DELTA_LOG_SUFFIX))
 
-        for idx,(k,v) in enumerate(loaded_frames.items()):
-            if 'text' in v:
-                text = v['text'] if v['text'] is not None else ''
-                self.frames[self.name_to_idx_map[k]].set_text(text)
+        for k, v in loaded.items():
+            idx = self.name_to_idx_map.get(k)
+            if idx is not None and 'text' in v:
+                frame = self.frames[idx]
+                frame.text = v['text'] if v['text'] is not None else ''
+                frame.dirty = False
+
+        self.base_path = path
 
     def restore(self, path):
+        '''
+        Applies the entries of the journal of an unfinished session.
+        The journal is kept as is, so the restored entries are not written to it again
+        '''
         assert self.frames
-        restored_frames = {k: v for line in open(path, 'r') for k, v in json.loads(line).items()}
-        os.remove(path)
-
-        for k,v in restored_frames.items():
-            idx = self.name_to_idx_map[k]
-            if 'text' in v:
-                self.frames[idx].set_text(v['text'])
-            self.save_frame(path, idx)
\ No newline at end of file
+        restored_frames = read_delta_log(path)
+
+        for k, v in restored_frames.items():
+            idx = self.name_to_idx_map.get(k)
+            if idx is not None and 'text' in v:
+                frame = self.frames[idx]
+                frame.text = v['text'] if v['text'] is not None else ''
+                frame.dirty = True
+
+    def close(self):
+        ''' Merges the delta log into the annotation and stops the writer '''
+        if self.base_path is not None:
+            self.writer.call(compact_annotation, self.base_path)
+        self.writer.close()
+
+    def _dump_lines(self, indices):
+        ''' Serializes the frames to json lines {name: {'text': text}} '''
+        lines = []
+        for idx in indices:
+            frame = self.frames[idx]
+            lines.append(json.dumps({PurePath(frame.img_path).parts[-1]: {'text': frame.text}}) + '\n')
+
+        return ''.join(lines)
+
+
+def read_delta_log(path):
+    ''' Reads the json lines of a delta log / journal (the later entries override the earlier ones) '''
+    entries = {}
+    if not os.path.isfile(path):
+        return entries
+    with open(path, 'r') as file:
+        for line in file:
+            try:
+                entries.update(json.loads(line))
+            except ValueError:
+                # The last line may be incomplete if the tool has been terminated while writing:
+                continue
+
+    return entries
+
+
+def read_annotation(path):
+    ''' Reads the annotation merged with its delta log '''
+    annotation = {}
+    if os.path.isfile(path):
+        with open(path, 'r') as file:
+            annotation = json.load(file)
+    annotation.update(read_delta_log(path + DELTA_LOG_SUFFIX))
+
+    return annotation
+
+
+def write_annotation(path, names, texts):
+    ''' Atomically writes the whole annotation and removes its (outdated) delta log '''
+    output = {name: {'text': text} for name, text in zip(names, texts)}
+    with open(path + '.tmp', 'w') as file:
+        json.dump(output, file, indent=2)
+    os.replace(path + '.tmp', path)
+    if os.path.isfile(path + DELTA_LOG_SUFFIX):
+        os.remove(path + DELTA_LOG_SUFFIX)
+
+
+def compact_annotation(path):
+    '''
+    Merges the delta log into the annotation. The log is removed only after the merged annotation
+    has replaced the old one, so an interrupted compaction just repeats the merge next time
+    '''
+    log_path = path + DELTA_LOG_SUFFIX
+    if not os.path.isfile(log_path):
+        return
+    output = read_annotation(path)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(output, file, indent=2)
+    os.replace(path + '.tmp', path)
+    os.remove(log_path)
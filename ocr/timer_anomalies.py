@@ -0,0 +1,148 @@
+import os
+import json
+import argparse
+import numpy as np
+
+from ocr.data_processor import read_annotation
+
+
+# Priorities of the frames which text cannot be checked against the neighbours:
+INVALID_TEXT_SCORE = 1e6
+EMPTY_TEXT_SCORE = 1e5
+
+
+def parse_timer_text(text):
+    '''
+    Converts the timer text to seconds:
+        'MMSS' or 'MSS' -> minutes and seconds (game clock),
+        'SS.t' or 'S.t' -> seconds and tenths,
+        'SS' or 'S'     -> seconds (shot clock).
+    Returns None for an empty text and NaN for a text that is not a valid timer value
+    '''
+    text = text.strip() if text is not None else ''
+    if len(text) == 0:
+        return None
+    try:
+        if '.' in text:
+            return float(text)
+        if not text.isdigit():
+            return np.nan
+        if len(text) <= 2:
+            return float(text)
+        minutes, seconds = int(text[:-2]), int(text[-2:])
+        if seconds >= 60:
+            return np.nan
+        return float(minutes * 60 + seconds)
+    except ValueError:
+        return np.nan
+
+
+def find_anomalies(texts, max_step=None):
+    '''
+    Checks that the timer values are consistent with a countdown (non-increasing in time)
+    compared with the neighbouring frames. The check is done for the whole sequence at once.
+    :param texts:    Timer texts of the frames in temporal order
+    :param max_step: Max allowed decrease (in seconds) between consecutive valid frames
+    :return: anomaly score of every frame (0 - consistent, the higher the more suspicious)
+    '''
+    num = len(texts)
+    values = np.full(num, np.nan)
+    empty = np.zeros(num, dtype=bool)
+    for i, text in enumerate(texts):
+        value = parse_timer_text(text)
+        if value is None:
+            empty[i] = True
+        else:
+            values[i] = value
+    valid = ~np.isnan(values)
+    invalid = ~valid & ~empty
+
+    scores = np.zeros(num)
+    scores[invalid] = INVALID_TEXT_SCORE
+    scores[empty] = EMPTY_TEXT_SCORE
+    if np.count_nonzero(valid) < 2:
+        return scores
+
+    # Values of the previous and next valid frames:
+    idx = np.arange(num)
+    prev_idx = np.maximum.accumulate(np.where(valid, idx, -1))
+    prev_idx = np.concatenate(([-1], prev_idx[:-1]))
+    next_idx = np.minimum.accumulate(np.where(valid, idx, num)[::-1])[::-1]
+    next_idx = np.concatenate((next_idx[1:], [num]))
+    has_prev, has_next = prev_idx >= 0, next_idx < num
+    padded = np.concatenate((values, [np.nan]))
+    # (the first and the last frames have a single neighbour, see below)
+    prev_v = np.where(has_prev, padded[prev_idx], np.inf)
+    next_v = np.where(has_next, padded[next_idx], -np.inf)
+
+    # Countdown: prev >= value >= next. A value outside of the neighbours' range is an outlier:
+    consistent = prev_v >= next_v
+    outlier = np.maximum(values - prev_v, 0) + np.maximum(next_v - values, 0)
+
+    # If the clock goes up around the frame (e.g. it has been reset), the value has to continue
+    # either the previous countdown or the next one:
+    jump = np.minimum(np.maximum(values - prev_v, 0), np.maximum(next_v - values, 0))
+    deviation = np.where(consistent, outlier, jump)
+
+    # The first and the last frames have a single neighbour, so if they are inconsistent it's not known
+    # which of the two is wrong. They are scored only if they are inconsistent with both next (previous)
+    # valid values too, otherwise the neighbour is the outlier:
+    valid_idx = np.flatnonzero(valid)
+    if len(valid_idx) >= 3:
+        first, last = valid_idx[0], valid_idx[-1]
+        deviation[first] = min(values[valid_idx[1]], values[valid_idx[2]]) - values[first]
+        deviation[last] = values[last] - max(values[valid_idx[-2]], values[valid_idx[-3]])
+
+    if max_step is not None:
+        step = np.where(has_prev & consistent, prev_v - values, 0)
+        deviation = np.maximum(deviation, step - max_step)
+
+    scores[valid] = np.maximum(deviation[valid], 0)
+
+    return scores
+
+
+def load_texts(names, preds_path, anno_path=None):
+    ''' Takes the manual texts if they exist otherwise the predicted ones '''
+    preds = json.load(open(preds_path, 'r'))
+    texts = [preds[name]['text'] if name in preds else None for name in names]
+
+    if anno_path is not None and os.path.isfile(anno_path):
+        # (with the changes of its delta log that have not been merged yet)
+        annos = read_annotation(anno_path)
+        texts = [annos[name]['text'] if name in annos and annos[name].get('text') is not None else text
+                 for name, text in zip(names, texts)]
+
+    return texts
+
+
+def build_review_queue(texts, min_score=0.5, max_step=None):
+    '''
+    Returns the indices of the suspicious frames sorted by priority (the most suspicious first)
+    and their scores
+    '''
+    scores = find_anomalies(texts, max_step)
+    indices = np.flatnonzero(scores >= min_score)
+    indices = indices[np.argsort(-scores[indices], kind='stable')]
+
+    return indices, scores[indices]
+
+
+def get_args():
+    parser = argparse.ArgumentParser('Finds suspicious timer predictions / annotations of a game')
+    parser.add_argument('img_dir', help='Directory containing the timer crops')
+    parser.add_argument('preds_path', help='Predictions json')
+    parser.add_argument('--anno_path', default=None, help='Manual annotations json')
+    parser.add_argument('--max_step', type=float, default=None,
+                        help='Max allowed decrease of the timer between consecutive frames (in seconds)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    names = sorted(file for file in os.listdir(args.img_dir) if not file.endswith('.'))
+    texts = load_texts(names, args.preds_path, args.anno_path)
+    indices, scores = build_review_queue(texts, max_step=args.max_step)
+    for idx, score in zip(indices, scores):
+        print('{}: {:.1f}'.format(names[idx], score))
+    print('Suspicious frames: {}/{}'.format(len(indices), len(names)))
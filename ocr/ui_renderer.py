@@ -1,5 +1,6 @@
 import cv2
 import numpy as np
+from collections import OrderedDict
 
 
 class FrameLayer:
@@ -11,7 +12,8 @@ class FrameLayer:
     def draw(self, frame=None):
         if frame is not None:
             assert frame.img is not None
-            img_h, img_w = frame.img.shape[0:2]
+            img = frame.img
+            img_h, img_w = img.shape[0:2]
             H, W = self.size[0], self.size[1]
 
             if self.align_by_width:
@@ -20,11 +22,11 @@ class FrameLayer:
                     r = W/img_w
                     new_w = W
                     new_h = int(round(img_h*r))
-                    frame.img = cv2.resize(frame.img, (new_w, new_h), interpolation=inter)
+                    img = cv2.resize(img, (new_w, new_h), interpolation=inter)
             else:
                 raise NotImplementedError
 
-            img_h, img_w = frame.img.shape[0:2]
+            img_h, img_w = img.shape[0:2]
             self.canvas = np.zeros((H, W, 3), dtype=np.uint8)
             dx = int(round((W - img_w) * 0.5))
             dy = int(round((H - img_h) * 0.5))
@@ -32,26 +34,35 @@ class FrameLayer:
                 dx = (dx+img_w) - W
             if dy+img_h > H:
                 dy = (dy+img_h) - H
-            self.canvas[dy:dy+img_h, dx:dx+img_w, :] = frame.img
+            self.canvas[dy:dy+img_h, dx:dx+img_w, :] = img
 
         return self.canvas
 
 class TextEditLayer:
-    ''' Layer allows to display, type and edit text data '''
+    '''
+    Layer allows to display, type and edit text data.
+    The cells are drawn directly into the target canvas from a cache of pre-rendered glyph cells,
+    and only the cells that have changed since the previous drawing are updated
+    '''
 
-    def __init__(self, size=(600, 600), num_cells=4):
-        self.canvas = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+    def __init__(self, size=(600, 600), num_cells=4, chars='0123456789. '):
+        self.size = size
         self.font = cv2.FONT_HERSHEY_COMPLEX
         self.text_color = (0,255,0)
         self.highlighted_text_color = (255, 0, 0)
         self.cell_width = 100
         self.cell_height = 150
         self.cell_margin = 25
+        self.border = 6
         self.origin_x = 50
         self.origin_y = 25
         self.num_cells = num_cells
         self.cell_boxes = []
         self.selected_cell_idx = -1
+        self.chars = chars
+        self.glyphs = {}                        # (char, selected, w, h) -> image of the cell
+        self.cell_states = [None] * num_cells   # what is drawn in each cell of the target canvas
+        self.target_pos = None
 
         # Calculate the coordinates of cells:
         x1, y1 = self.origin_x, self.origin_y
@@ -61,25 +72,64 @@ class TextEditLayer:
             x2, y2 = x1 + self.cell_width, y1 + self.cell_height
             self.cell_boxes.append((x1,y1,x2,y2))
 
-    def draw(self, text=None):
-        self.canvas.fill(0)
-        for i, (x1,y1,x2,y2) in enumerate(self.cell_boxes):
-            self.canvas = cv2.rectangle(self.canvas, (x1, y1), (x2, y2), (255, 255, 255), -1)
-            if self.selected_cell_idx == i:
-                self.canvas = cv2.rectangle(self.canvas, (x1-1, y1-1), (x2+2, y2+2), (255, 0, 0), 7)
-
-        if text is not None:
-            chars = list(text)
-            for i in range(len(chars)):
-                if i >= self.num_cells:
-                    break
-                color = self.text_color
-                if self.selected_cell_idx == i:
-                    color= self.highlighted_text_color
-                x, y = self.cell_boxes[i][0]+10, self.cell_boxes[i][3]-20
-                UIRenderer.draw_text(self.canvas, chars[i], (x, y), color, scale=4, font=self.font)
+    def draw(self, canvas, pos, text=None):
+        '''
+        Draws the changed cells into the area pos=(x,y,w,h) of the canvas
+        '''
+        if pos != self.target_pos:
+            self.reset()
+            self.target_pos = pos
+            for char in list(self.chars) + ['']:
+                for selected in (False, True):
+                    self._get_glyph(char, selected, *self._get_target_box(0, pos)[2:])
+        chars = list(text) if text is not None else []
 
-        return self.canvas
+        for i in range(self.num_cells):
+            state = (chars[i] if i < len(chars) else '', self.selected_cell_idx == i)
+            if state == self.cell_states[i]:
+                continue
+            x, y, w, h = self._get_target_box(i, pos)
+            canvas[y:y+h, x:x+w] = self._get_glyph(state[0], state[1], w, h)
+            self.cell_states[i] = state
+
+        return canvas
+
+    def reset(self):
+        ''' Forces all the cells to be redrawn '''
+        self.cell_states = [None] * self.num_cells
+
+    def _get_target_box(self, i, pos):
+        ''' Box of the cell (including its selection border) in the target canvas '''
+        x1, y1, x2, y2 = self.cell_boxes[i]
+        rx, ry = pos[2] / self.size[0], pos[3] / self.size[1]
+        tx1 = pos[0] + int(round((x1 - self.border) * rx))
+        ty1 = pos[1] + int(round((y1 - self.border) * ry))
+        tx2 = pos[0] + int(round((x2 + self.border) * rx))
+        ty2 = pos[1] + int(round((y2 + self.border) * ry))
+
+        return tx1, ty1, tx2 - tx1, ty2 - ty1
+
+    def _get_glyph(self, char, selected, w, h):
+        key = (char, selected, w, h)
+        glyph = self.glyphs.get(key)
+        if glyph is None:
+            # Render the cell in the layer's resolution and resize it to the target one:
+            b = self.border
+            cell = np.zeros((self.cell_height + 2*b, self.cell_width + 2*b, 3), dtype=np.uint8)
+            x1, y1, x2, y2 = b, b, b + self.cell_width, b + self.cell_height
+            cv2.rectangle(cell, (x1, y1), (x2, y2), (255, 255, 255), -1)
+            color = self.text_color
+            if selected:
+                cv2.rectangle(cell, (x1-1, y1-1), (x2+2, y2+2), (255, 0, 0), 7)
+                color = self.highlighted_text_color
+            if char:
+                UIRenderer.draw_text(cell, char, (x1+10, y2-20), color, scale=4, font=self.font)
+            if cell.shape[1] != w or cell.shape[0] != h:
+                inter = cv2.INTER_AREA if cell.shape[1] > w else cv2.INTER_CUBIC
+                cell = cv2.resize(cell, (w, h), interpolation=inter)
+            glyph = self.glyphs[key] = cell
+
+        return glyph
 
     def select_cell(self, idx=None, change_to=None):
         if idx is not None:
@@ -96,6 +146,117 @@ class TextEditLayer:
 
         return self.selected_cell_idx
 
+class GridLayer:
+    '''
+    Layer showing a page of frames as a grid of tiles (the image and its text) for batch annotating.
+    The resized images are cached and only the tiles that have changed are redrawn
+    '''
+
+    def __init__(self, size=(600, 600), num_cols=4, num_rows=6, status_height=40, max_cached=1000):
+        self.size = size
+        self.num_cols = num_cols
+        self.num_rows = num_rows
+        self.num_cells = num_cols * num_rows
+        self.status_height = status_height
+        self.cell_width = size[0] // num_cols
+        self.cell_height = (size[1] - status_height) // num_rows
+        self.text_height = int(round(self.cell_height * 0.4))
+        self.margin = 3
+        self.font = cv2.FONT_HERSHEY_COMPLEX
+        self.text_color = (0, 255, 0)
+        self.canvas = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+        self.max_cached = max_cached
+        self.cached_imgs = OrderedDict()     # frame idx -> image resized to the tile
+        self.cell_states = [None] * self.num_cells
+        self.status = None
+
+        # Calculate the coordinates of cells:
+        self.cell_boxes = []
+        for i in range(self.num_cells):
+            x1 = (i % num_cols) * self.cell_width
+            y1 = (i // num_cols) * self.cell_height
+            self.cell_boxes.append((x1, y1, x1 + self.cell_width, y1 + self.cell_height))
+
+    def draw(self, frames, page_start, cursor, selection, status=''):
+        '''
+        :param frames:     Frames of the page
+        :param page_start: Index of the first frame of the page
+        :param cursor:     Index of the current frame
+        :param selection:  Range (first, last) of the selected frames
+        :param status:     Text of the status line
+        '''
+        for i in range(self.num_cells):
+            if i < len(frames):
+                idx = page_start + i
+                selected = selection[0] <= idx <= selection[1]
+                state = (idx, frames[i].text, idx == cursor, selected)
+            else:
+                state = None
+
+            # Redraw only the changed cells:
+            if state != self.cell_states[i]:
+                self._draw_cell(i, frames[i] if state is not None else None, state)
+                self.cell_states[i] = state
+
+        if status != self.status:
+            self.canvas[-self.status_height:].fill(0)
+            UIRenderer.draw_text(self.canvas, status, (10, self.size[1] - 12), (255, 255, 255), scale=0.8,
+                                 font=self.font)
+            self.status = status
+
+        return self.canvas
+
+    def reset(self):
+        ''' Forces all the cells to be redrawn '''
+        self.cell_states = [None] * self.num_cells
+        self.status = None
+
+    def get_cell_idx(self, x, y):
+        for i, (x1, y1, x2, y2) in enumerate(self.cell_boxes):
+            if x1 <= x < x2 and y1 <= y < y2:
+                return i
+        return -1
+
+    def _get_tile_img(self, idx, frame):
+        img = self.cached_imgs.get(idx)
+        if img is None:
+            assert frame.img is not None
+            w = self.cell_width - 2 * self.margin
+            h = self.cell_height - self.text_height - 2 * self.margin
+            img_h, img_w = frame.img.shape[0:2]
+            r = min(w / img_w, h / img_h)
+            new_w, new_h = max(int(img_w * r), 1), max(int(img_h * r), 1)
+            inter = cv2.INTER_AREA if r < 1 else cv2.INTER_CUBIC
+            img = cv2.resize(frame.img, (new_w, new_h), interpolation=inter)
+            self.cached_imgs[idx] = img
+            if len(self.cached_imgs) > self.max_cached:
+                self.cached_imgs.popitem(last=False)
+        else:
+            self.cached_imgs.move_to_end(idx)
+
+        return img
+
+    def _draw_cell(self, i, frame, state):
+        x1, y1, x2, y2 = self.cell_boxes[i]
+        cell = self.canvas[y1:y2, x1:x2]
+        cell.fill(0)
+        if state is None:
+            return
+        idx, text, is_cursor, selected = state
+
+        if selected:
+            cell.fill(64)
+        img = self._get_tile_img(idx, frame)
+        img_h, img_w = img.shape[0:2]
+        dx = (self.cell_width - img_w) // 2
+        dy = self.margin
+        cell[dy:dy+img_h, dx:dx+img_w] = img
+
+        UIRenderer.draw_text(cell, text, (self.margin + 4, self.cell_height - self.margin - 6), self.text_color,
+                             scale=0.9, font=self.font)
+        if is_cursor:
+            cv2.rectangle(cell, (1, 1), (self.cell_width - 2, self.cell_height - 2), (255, 0, 0), 2)
+
 class UIRenderer:
     '''  Implements a Graphical User Interface '''
     def __init__(self, window_name, canvas_size=(1920, 1080)):
@@ -105,6 +266,11 @@ class UIRenderer:
         self.text_layer_pos = UIRenderer.calc_pos_on_canvas((0.25, 0.4, 0.50, 0.50), self.canvas_size)
         self.frame_layer = FrameLayer()
         self.text_layer = TextEditLayer(size=(600,600))
+        self.grid_layer = GridLayer(size=self.canvas_size)
+        self.grid_layer_pos = (0, 0, self.canvas_size[0], self.canvas_size[1])
+        self.canvas = None
+        self.rendered_frame = None
+        self.rendered_img = None
 
     def create_window(self, mouse_handler, trackbar_handler, num_data, window_size=(1280,720)):
         cv2.namedWindow(self.window_name, cv2.WINDOW_GUI_NORMAL)
@@ -113,17 +279,35 @@ class UIRenderer:
         cv2.createTrackbar('frames', self.window_name, 1, num_data, trackbar_handler)
 
     def render(self, frame=None):
-        ''' Renders GUI and returns the main canvas '''
+        ''' Renders GUI updating only the changed parts of the main canvas '''
+        if self.window_name is None:
+            print ('No windows have been created yet!')
+            return
+
+        if self.canvas is None:
+            self.canvas = np.zeros((self.canvas_size[1], self.canvas_size[0], 3), dtype=np.uint8)
+            self.rendered_frame = None
+            self.text_layer.reset()
+
+        # The frame layer is redrawn only when the frame (or its image) changes:
+        if frame is not self.rendered_frame or frame.img is not self.rendered_img:
+            frame_canvas = self.frame_layer.draw(frame)
+            UIRenderer.insert_into_canvas(self.canvas, frame_canvas, self.frame_layer_pos)
+            self.rendered_frame, self.rendered_img = frame, frame.img
+
+        self.text_layer.draw(self.canvas, self.text_layer_pos, frame.text)
+        cv2.imshow(self.window_name, self.canvas)
+        self.grid_layer.reset()
+
+    def render_grid(self, frames, page_start, cursor, selection, status=''):
+        ''' Renders a page of frames as a grid (see GridLayer.draw) '''
         if self.window_name is None:
             print ('No windows have been created yet!')
             return
 
-        canvas = np.zeros((self.canvas_size[1], self.canvas_size[0], 3), dtype=np.uint8)
-        frame_canvas = self.frame_layer.draw(frame)
-        text_canvas = self.text_layer.draw(frame.text)
-        UIRenderer.insert_into_canvas(canvas, frame_canvas, self.frame_layer_pos)
-        UIRenderer.insert_into_canvas(canvas, text_canvas, self.text_layer_pos)
+        canvas = self.grid_layer.draw(frames, page_start, cursor, selection, status)
         cv2.imshow(self.window_name, canvas)
+        self.canvas = None
 
     def is_window_visible(self):
         if self.window_name is None:
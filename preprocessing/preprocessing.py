@@ -1,15 +1,33 @@
 import os
 import numpy as np
 import cv2
-from shutil import copy
+from shutil import copy, move
 import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from timeit import default_timer as timer
 from tqdm import tqdm
 from skimage.metrics import structural_similarity as ssim
 
 
-def prepare_scorebug_template(img_path, dst_dir):
-    template_img_path = os.path.join(dst_dir, 'template.jpeg')
-    template_meta_path = os.path.join(dst_dir, 'template.json')
+SCORES_FILE_NAME = 'scorebug_scores.json'
+VIDEO_SCORES_FILE_NAME = 'scorebug_video_scores.json'
+RANGES_FILE_NAME = 'scorebug_ranges.json'           # ranges of the video frame ids (--video)
+INTERVALS_FILE_NAME = 'scorebug_intervals.json'     # intervals of the extracted frames (--intervals)
+MANIFEST_FILE_NAME = 'scorebug_manifest.json'
+PARTITION_MODES = ('copy', 'hardlink', 'symlink', 'move', 'manifest')
+TEMPLATE_SCALE = (0.25, 0.5)    # (fx, fy) the scorebug ROI is resized with
+REDUCED_GRAYSCALE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8
+}
+
+
+def prepare_scorebug_template(img_path, dst_dir, template_id='template'):
+    template_img_path = os.path.join(dst_dir, template_id + '.jpeg')
+    template_meta_path = os.path.join(dst_dir, template_id + '.json')
 
     if not os.path.exists(dst_dir):
         os.makedirs(dst_dir)
@@ -33,18 +51,12 @@ def prepare_scorebug_template(img_path, dst_dir):
     print ('Done!')
 
 
-def get_frames_with_scorebug(data_dir, threshold=0.4):
-    frames_dir = os.path.join(data_dir, 'frames')
-    target_dir = os.path.join(data_dir, 'frames_target')
-    dropped_dir = os.path.join(data_dir, 'frames_dropped')
-
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir)
-    if not os.path.exists(dropped_dir):
-        os.makedirs(dropped_dir)
-
-    # Open a template:
-    template_meta_path = os.path.join(data_dir, 'scorebug_templates/template.json')
+def load_scorebug_template(data_dir, template_id='template'):
+    '''
+    Returns the resized grayscale scorebug template, its ROI (x1, y1, x2, y2) in the frame
+    and the template meta
+    '''
+    template_meta_path = os.path.join(data_dir, 'scorebug_templates', template_id + '.json')
     with open(template_meta_path, 'r') as f:
         meta = json.load(f)
     template_img_path = os.path.join(data_dir, 'scorebug_templates', meta['img_name'])
@@ -52,43 +64,623 @@ def get_frames_with_scorebug(data_dir, threshold=0.4):
     x1, y1 = meta['x'], meta['y']
     x2, y2 = x1 + meta['w'], y1 + meta['h']
     scorebug_template = template_img[y1:y2, x1:x2]
-    scorebug_template = cv2.resize(scorebug_template, (0,0), fx=0.25, fy=0.5)
-    H, W = scorebug_template.shape[:2]
-
-    # Get src frame names:
-    paths = [os.path.join(frames_dir, file) for file in os.listdir(frames_dir) if not file.endswith('.')]
-    paths = sorted(paths)
-    # paths = paths[143000:144000]
-    dropped_count, target_count = 0, 0
-
-    with tqdm(total=len(paths), desc=f'Processing', unit='img') as pbar:
-        for img_path in paths:
-            name = img_path.split('/')[-1]
-            img = cv2.imread(img_path, 0)[y1:y2, x1:x2]
-            img = cv2.resize(img, (W, H))
-            score = ssim(scorebug_template, img)
-            # print (name, score)
-
-            if score > threshold:
-                dst_path = os.path.join(target_dir, name)
-                target_count += 1
-            else:
-                dst_path = os.path.join(dropped_dir, name)
-                dropped_count += 1
-
-            copy(img_path, dst_path)
-
-            pbar.update(1)
+    scorebug_template = cv2.resize(scorebug_template, (0,0), fx=TEMPLATE_SCALE[0], fy=TEMPLATE_SCALE[1])
+
+    return scorebug_template, (x1, y1, x2, y2), meta
+
+
+def get_reduction_factor(scale=TEMPLATE_SCALE):
+    '''
+    The largest JPEG decoding reduction (1, 2, 4 or 8) that does not go below the template resolution,
+    so the decoded ROI is still only downscaled to the template size
+    '''
+    factor = 1
+    while factor < 8 and factor * 2 * max(scale) <= 1:
+        factor *= 2
+
+    return factor
+
+
+def scale_roi(roi, factor):
+    ''' ROI coordinates in the image decoded with the reduction factor '''
+    x1, y1, x2, y2 = roi
+    return (int(round(x1 / factor)), int(round(y1 / factor)),
+            max(int(round(x2 / factor)), int(round(x1 / factor)) + 1),
+            max(int(round(y2 / factor)), int(round(y1 / factor)) + 1))
+
+
+def decode_roi_cv2(img_path, roi, factor=1):
+    ''' Decodes the grayscale image reduced by the factor and crops the ROI '''
+    img = cv2.imread(img_path, REDUCED_GRAYSCALE_FLAGS[factor])
+    if img is None:
+        return None
+    x1, y1, x2, y2 = scale_roi(roi, factor)
+
+    return img[y1:y2, x1:x2]
+
+
+_turbo_jpeg = None
+
+def decode_roi_turbojpeg(img_path, roi, factor=1):
+    '''
+    Decodes only the iMCU rows / columns around the ROI (lossless crop of the JPEG stream)
+    with the reduction factor. Requires PyTurboJPEG and libturbojpeg
+    '''
+    global _turbo_jpeg
+    from turbojpeg import TurboJPEG, TJPF_GRAY, tjMCUWidth, tjMCUHeight
+    if _turbo_jpeg is None:
+        _turbo_jpeg = TurboJPEG()
+
+    with open(img_path, 'rb') as f:
+        jpeg_buf = f.read()
+    _, _, subsample, _ = _turbo_jpeg.decode_header(jpeg_buf)
+    x1, y1, x2, y2 = roi
+    # The crop starts at the iMCU boundary before the ROI:
+    ox, oy = x1 % tjMCUWidth[subsample], y1 % tjMCUHeight[subsample]
+    cropped = _turbo_jpeg.crop(jpeg_buf, x1, y1, x2 - x1, y2 - y1)
+    img = _turbo_jpeg.decode(cropped, pixel_format=TJPF_GRAY, scaling_factor=(1, factor))
+    x1, y1, x2, y2 = scale_roi((ox, oy, ox + x2 - x1, oy + y2 - y1), factor)
+
+    return img[y1:y2, x1:x2, 0]
+
+
+# Decoders of the ROI: decoder(img_path, roi, factor) -> grayscale ROI reduced by the factor:
+ROI_DECODERS = {
+    'cv2': decode_roi_cv2,
+    'turbojpeg': decode_roi_turbojpeg
+}
+
+
+def _box_means(x, win_size):
+    '''
+    Means over the win_size x win_size windows of (B, H, W) images. The images are stacked vertically
+    and filtered at once: only the windows that fit into a single image are valid
+    '''
+    return cv2.boxFilter(x.reshape(-1, x.shape[-1]), -1, (win_size, win_size), normalize=True).reshape(x.shape)
+
+
+class BatchSSIM:
+    '''
+    SSIM of a batch of images against the fixed template computed at once.
+    Matches skimage.metrics.structural_similarity with its defaults (7x7 uniform window,
+    sample covariance, only the windows that fit into the image are averaged).
+    The statistics of the template are computed once. The local statistics are computed in float32
+    (the difference from skimage is ~1e-6)
+    '''
+
+    def __init__(self, template, win_size=7, data_range=255, K1=0.01, K2=0.03):
+        assert min(template.shape[:2]) >= win_size
+        self.win_size = win_size
+        self.pad = (win_size - 1) // 2
+        self.C1 = np.float32((K1 * data_range) ** 2)
+        self.C2 = np.float32((K2 * data_range) ** 2)
+        num_pixels = win_size * win_size
+        self.cov_norm = np.float32(num_pixels / (num_pixels - 1))
+
+        self.template = template.astype(np.float32)
+        self.uy = _box_means(self.template[None], win_size)
+        self.vy = self.cov_norm * (_box_means(self.template[None] ** 2, win_size) - self.uy * self.uy)
+        self.uy2_C1 = self.uy * self.uy + self.C1
+        self.vy_C2 = self.vy + self.C2
+
+    def __call__(self, imgs):
+        ''' imgs: (B, H, W) array of the images of the template size, returns (B,) scores '''
+        x = np.asarray(imgs, dtype=np.float32)
+        ux = _box_means(x, self.win_size)
+        uxx = _box_means(x * x, self.win_size)
+        uxy = _box_means(x * self.template, self.win_size)
+
+        ux_uy = ux * self.uy
+        ux2 = ux * ux
+        num = (2 * ux_uy + self.C1) * (2 * self.cov_norm * (uxy - ux_uy) + self.C2)
+        den = (ux2 + self.uy2_C1) * (self.cov_norm * (uxx - ux2) + self.vy_C2)
+        s = num / den
+
+        p = self.pad
+        return s[:, p:s.shape[1] - p, p:s.shape[2] - p].mean(axis=(1, 2), dtype=np.float64)
+
+
+class TemplateBank:
+    '''
+    Scorebug templates of the different graphics packages (every scorebug_templates/<id>.json).
+    The templates are loaded, cropped and normalized once. The union of their ROIs is decoded
+    once per frame and all the templates are scored against it in batches
+    '''
+
+    def __init__(self, data_dir):
+        templates_dir = os.path.join(data_dir, 'scorebug_templates')
+        self.ids = sorted(file[:-len('.json')] for file in os.listdir(templates_dir) if file.endswith('.json'))
+        assert self.ids, 'No templates found in {}'.format(templates_dir)
+        self.templates, self.rois, self.metas = [], [], []
+        for template_id in self.ids:
+            template, roi, meta = load_scorebug_template(data_dir, template_id)
+            self.templates.append(template)
+            self.rois.append(roi)
+            self.metas.append(meta)
+        self.ssims = [BatchSSIM(template) for template in self.templates]
+
+        # All the ROIs are cropped from their union:
+        rois = np.array(self.rois)
+        self.roi = (int(rois[:, 0].min()), int(rois[:, 1].min()), int(rois[:, 2].max()), int(rois[:, 3].max()))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def crop_rois(self, img, factor=1):
+        ''' Crops the templates' ROIs from the union ROI decoded with the reduction factor '''
+        ux, uy, _, _ = scale_roi(self.roi, factor)
+        crops = []
+        for template, roi in zip(self.templates, self.rois):
+            x1, y1, x2, y2 = scale_roi(roi, factor)
+            crops.append(cv2.resize(img[y1 - uy:y2 - uy, x1 - ux:x2 - ux], (template.shape[1], template.shape[0])))
+
+        return crops
+
+    def read_rois(self, paths, decoder='cv2', factor=1):
+        ''' Decodes the ROIs of the frames as a (B, H, W) array per template '''
+        batches = [np.empty((len(paths),) + template.shape[:2], dtype=np.uint8) for template in self.templates]
+        for i, img_path in enumerate(paths):
+            img = ROI_DECODERS[decoder](img_path, self.roi, factor)
+            for batch, crop in zip(batches, self.crop_rois(img, factor)):
+                batch[i] = crop
+
+        return batches
+
+    def score(self, batches):
+        ''' Returns the best score of every frame and the index of the best template '''
+        scores = np.stack([batch_ssim(batch) for batch_ssim, batch in zip(self.ssims, batches)])
+        best = scores.argmax(axis=0)
+
+        return scores[best, np.arange(scores.shape[1])], best
+
+
+def _score_chunk(task):
+    paths, bank, decoder, factor = task
+    scores, best = bank.score(bank.read_rois(paths, decoder, factor))
+
+    return scores.tolist(), [bank.ids[i] for i in best]
+
+
+def compute_scorebug_scores(paths, bank, decoder='cv2', factor=1, num_workers=None, chunk_size=256):
+    '''
+    Scores the frames in parallel processes (by chunks of the sorted paths).
+    Returns the best score of every frame and the id of the best matching template
+    '''
+    scores, template_ids = [], []
+    tasks = [(paths[i:i + chunk_size], bank, decoder, factor) for i in range(0, len(paths), chunk_size)]
+
+    with tqdm(total=len(paths), desc=f'Scoring', unit='img') as pbar, \
+            ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for chunk_scores, chunk_ids in pool.map(_score_chunk, tasks):
+            scores.extend(chunk_scores)
+            template_ids.extend(chunk_ids)
+            pbar.update(len(chunk_scores))
+
+    return scores, template_ids
+
+
+def benchmark_ssim(data_dir, num_frames=1000, batch_size=256):
+    ''' Compares the throughput and the scores of the per-frame skimage SSIM and BatchSSIM '''
+    frames_dir = os.path.join(data_dir, 'frames')
+    paths = sorted(os.path.join(frames_dir, file) for file in os.listdir(frames_dir) if not file.endswith('.'))
+    bank = TemplateBank(data_dir)
+    template = bank.templates[0]
+    imgs = bank.read_rois(paths[:num_frames], factor=get_reduction_factor())[0]
+
+    start = timer()
+    ref_scores = np.array([ssim(template, img) for img in imgs])
+    ref_time = timer() - start
+
+    batch_ssim = BatchSSIM(template)
+    start = timer()
+    scores = np.concatenate([batch_ssim(imgs[i:i + batch_size]) for i in range(0, len(imgs), batch_size)])
+    batch_time = timer() - start
+
+    print('Frames: {}, ROI: {}x{}'.format(len(imgs), template.shape[1], template.shape[0]))
+    print('skimage: {:.0f} frames/s, batched: {:.0f} frames/s ({:.1f}x)'.format(
+        len(imgs) / ref_time, len(imgs) / batch_time, ref_time / batch_time))
+    print('Max abs difference: {:.2e}'.format(np.abs(scores - ref_scores).max()))
+
+
+def load_scorebug_scores(path, params):
+    ''' Returns the saved scores and template ids if they have been computed with the same params '''
+    if not os.path.isfile(path):
+        return {}, {}
+    with open(path, 'r') as f:
+        saved = json.load(f)
+    if saved.get('params') != params:
+        return {}, {}
+
+    return saved['scores'], saved['templates']
+
+
+def save_scorebug_scores(path, params, scores, template_ids):
+    '''
+    Saves {frame name: score} and {frame name: best template id},
+    so the threshold can be re-tuned without recomputing the scores
+    '''
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'params': params, 'scores': scores, 'templates': template_ids}, f, indent=0)
+    os.replace(path + '.tmp', path)
+
+
+def get_bank_params(bank, **kwargs):
+    '''
+    Params the scores depend on (the saved scores are valid only for the same params).
+    Only the image and the ROI of the templates count, so e.g. adding a timer ROI keeps the scores
+    '''
+    keys = ('img_name', 'x', 'y', 'w', 'h')
+    params = {'templates': {template_id: {key: meta[key] for key in keys}
+                            for template_id, meta in zip(bank.ids, bank.metas)}}
+    params.update(kwargs)
+
+    return params
+
+
+def _place_files(task):
+    ''' Places a batch of files into their destinations with the given method '''
+    pairs, mode = task
+    for src_path, dst_path in pairs:
+        if mode == 'hardlink':
+            os.link(src_path, dst_path)
+        elif mode == 'symlink':
+            os.symlink(os.path.abspath(src_path), dst_path)
+        elif mode == 'move':
+            move(src_path, dst_path)
+        else:
+            copy(src_path, dst_path)
+
+    return len(pairs)
+
+
+def partition_frames(paths, names, keep, target_dir, dropped_dir, mode='copy', num_workers=None, batch_size=256):
+    '''
+    Places the frames into target_dir (keep is True) or dropped_dir with one of PARTITION_MODES.
+    The frames that are already in the right directory are skipped, the ones that are in the wrong one
+    (e.g. the threshold has changed) are removed from there. The files are placed in batches by
+    parallel threads
+    '''
+    for dir_path in (target_dir, dropped_dir):
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+    existing = {target_dir: set(os.listdir(target_dir)), dropped_dir: set(os.listdir(dropped_dir))}
+
+    pairs = []
+    num_relocated = 0
+    for img_path, name, k in zip(paths, names, keep):
+        dst_dir, other_dir = (target_dir, dropped_dir) if k else (dropped_dir, target_dir)
+        if name in existing[other_dir]:
+            other_path = os.path.join(other_dir, name)
+            if os.path.abspath(img_path) == os.path.abspath(other_path):
+                # The frame has been moved there by a previous run (mode 'move'), so it's moved across:
+                os.replace(other_path, os.path.join(dst_dir, name))
+                num_relocated += 1
+                continue
+            os.remove(other_path)
+        if name not in existing[dst_dir]:
+            pairs.append((img_path, os.path.join(dst_dir, name)))
+
+    tasks = [(pairs[i:i + batch_size], mode) for i in range(0, len(pairs), batch_size)]
+    with tqdm(total=len(pairs), desc=f'Processing', unit='img') as pbar, \
+            ThreadPoolExecutor(max_workers=num_workers) as pool:
+        for num_placed in pool.map(_place_files, tasks):
+            pbar.update(num_placed)
+
+    return len(pairs) + num_relocated
+
+
+def list_frames(data_dir):
+    '''
+    Returns the paths and the names (sorted by name) of the extracted frames of the game.
+    The frames moved to frames_target / frames_dropped by the previous runs (mode 'move')
+    are taken from there
+    '''
+    found = {}
+    # (frames/ goes last, so its files are preferred to the copies)
+    for dir_name in ('frames_dropped', 'frames_target', 'frames'):
+        dir_path = os.path.join(data_dir, dir_name)
+        if not os.path.isdir(dir_path):
+            continue
+        for file in os.listdir(dir_path):
+            if not file.endswith('.'):
+                found[file] = os.path.join(dir_path, file)
+    names = sorted(found)
+
+    return [found[name] for name in names], names
+
+
+def get_frames_with_scorebug(data_dir, threshold=0.4, num_workers=None, recompute=False,
+                             decoder='cv2', reduced=True, mode='copy'):
+    '''
+    :param decoder: Name of the ROI decoder (see ROI_DECODERS)
+    :param reduced: Decode the frames at the reduced resolution chosen from the template scale
+    :param mode:    How the frames are placed into frames_target / frames_dropped (see PARTITION_MODES).
+                    The manifest of the frames with the scorebug is written anyway
+    '''
+    target_dir = os.path.join(data_dir, 'frames_target')
+    dropped_dir = os.path.join(data_dir, 'frames_dropped')
+    scores_path = os.path.join(data_dir, SCORES_FILE_NAME)
+    manifest_path = os.path.join(data_dir, MANIFEST_FILE_NAME)
+    assert mode in PARTITION_MODES, mode
+
+    # Get src frame names (the manifest is never overwritten with an empty one):
+    paths, names = list_frames(data_dir)
+    assert names, 'No frames found in {}'.format(data_dir)
+
+    # Score only the frames that have not been scored by the previous runs:
+    bank = TemplateBank(data_dir)
+    factor = get_reduction_factor() if reduced else 1
+    params = get_bank_params(bank, decoder=decoder, factor=factor)
+    scores, template_ids = ({}, {}) if recompute else load_scorebug_scores(scores_path, params)
+    to_score = [(img_path, name) for img_path, name in zip(paths, names) if name not in scores]
+    if to_score:
+        new_scores, new_ids = compute_scorebug_scores([p for p, _ in to_score], bank, decoder, factor, num_workers)
+        scores.update(zip([name for _, name in to_score], new_scores))
+        template_ids.update(zip([name for _, name in to_score], new_ids))
+        save_scorebug_scores(scores_path, params, scores, template_ids)
+    keep = [scores[name] > threshold for name in names]
+    target_count = sum(keep)
+    dropped_count = len(keep) - target_count
+
+    manifest = {
+        'threshold': threshold,
+        'target': [[name, template_ids[name]] for name, k in zip(names, keep) if k],
+        'dropped': [name for name, k in zip(names, keep) if not k]
+    }
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=0)
+
+    if mode != 'manifest':
+        partition_frames(paths, names, keep, target_dir, dropped_dir, mode, num_workers)
 
     print ('Done! Target frames: {}, dropped frames: {}'.format(target_count, dropped_count))
+    if len(bank) > 1:
+        for template_id in bank.ids:
+            print ('Template \'{}\': {} frames'.format(template_id, sum(
+                1 for name in names if scores[name] > threshold and template_ids[name] == template_id)))
 
 
+def find_scorebug_intervals(data_dir, threshold=0.4, num_workers=None, recompute=False,
+                            decoder='cv2', reduced=True, sample_step=50):
+    '''
+    Finds the [start, end, template id] intervals of the frames with the scorebug without scoring
+    every frame. The frames are sampled every sample_step frames, and only the gaps where
+    the classification (no scorebug or the best template) changes between the samples are bisected
+    to the exact boundary frames. The changes shorter than sample_step may be missed.
+    The intervals are written as the indices of the sorted frames and as the names of their first and last frames
+    '''
+    scores_path = os.path.join(data_dir, SCORES_FILE_NAME)
+    ranges_path = os.path.join(data_dir, INTERVALS_FILE_NAME)
 
-if __name__ == '__main__':
-    img_path = '/media/darkalert/c02b53af-522d-40c5-b824-80dfb9a11dbb/sota/football/video/VTB_mol_Ural_at_Dinamo/frames/image-37001.jpeg'
-    dst_dir = '/media/darkalert/c02b53af-522d-40c5-b824-80dfb9a11dbb/sota/football/video/VTB_mol_Ural_at_Dinamo/scorebug_templates'
-    # prepare_scorebug_template(img_path, dst_dir)
+    paths, names = list_frames(data_dir)
+    num_frames = len(paths)
+    assert num_frames > 0
+
+    bank = TemplateBank(data_dir)
+    factor = get_reduction_factor() if reduced else 1
+    params = get_bank_params(bank, decoder=decoder, factor=factor)
+    scores, template_ids = ({}, {}) if recompute else load_scorebug_scores(scores_path, params)
+    num_scored = 0
+    num_workers = num_workers or os.cpu_count()
 
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        def classify(indices):
+            ''' Scores the frames that have not been scored yet and returns their classes '''
+            nonlocal num_scored
+            to_score = [paths[i] for i in indices if names[i] not in scores]
+            if to_score:
+                chunk_size = (len(to_score) + num_workers - 1) // num_workers
+                tasks = [(to_score[i:i + chunk_size], bank, decoder, factor)
+                         for i in range(0, len(to_score), chunk_size)]
+                for chunk, (chunk_scores, chunk_ids) in zip(tasks, pool.map(_score_chunk, tasks)):
+                    chunk_names = [path.split('/')[-1] for path in chunk[0]]
+                    scores.update(zip(chunk_names, chunk_scores))
+                    template_ids.update(zip(chunk_names, chunk_ids))
+                num_scored += len(to_score)
+            return {i: template_ids[names[i]] if scores[names[i]] > threshold else None for i in indices}
 
-    data_dir = '/media/darkalert/c02b53af-522d-40c5-b824-80dfb9a11dbb/sota/football/video/VTB_mol_Ural_at_Dinamo'
-    get_frames_with_scorebug(data_dir)
\ No newline at end of file
+        # Sparse sampling:
+        samples = list(range(0, num_frames, sample_step))
+        if samples[-1] != num_frames - 1:
+            samples.append(num_frames - 1)
+        classes = classify(samples)
+
+        # Bisect all the gaps with a change at once (one batch per bisection round):
+        gaps = [[a, b] for a, b in zip(samples[:-1], samples[1:]) if classes[a] != classes[b]]
+        while any(b - a > 1 for a, b in gaps):
+            mids = [(a + b) // 2 for a, b in gaps if b - a > 1]
+            classes.update(classify(mids))
+            for gap in gaps:
+                a, b = gap
+                if b - a > 1:
+                    m = (a + b) // 2
+                    gap[classes[m] != classes[a]] = m
+
+    # The class changes only at the gaps' boundaries:
+    ranges = []
+    start = 0
+    for a, b in gaps + [[num_frames - 1, None]]:
+        if classes[a] is not None:
+            ranges.append([start, a, classes[a]])
+        start = b
+
+    save_scorebug_scores(scores_path, params, scores, template_ids)
+    output = {
+        'source': 'frames',
+        'threshold': threshold,
+        'sample_step': sample_step,
+        'num_frames': num_frames,
+        'ranges': ranges,
+        'names': [[names[start], names[end]] for start, end, _ in ranges]
+    }
+    with open(ranges_path, 'w') as f:
+        json.dump(output, f, indent=2)
+
+    print('Done! Intervals: {}, target frames: {}/{}, scored frames: {} ({:.1f}%)'.format(
+        len(ranges), sum(end - start + 1 for start, end, _ in ranges), num_frames,
+        num_scored, 100.0 * num_scored / num_frames))
+
+    return ranges
+
+
+def get_video_frame_name(frame_id):
+    return 'image-{:06d}.jpeg'.format(frame_id)
+
+
+def get_scorebug_ranges(frame_ids, classes, step=1):
+    '''
+    Merges the kept frames that follow each other (sampled with the step) and match the same template
+    into [start, end, template id] ranges. classes are the template ids of the frames (None - dropped)
+    '''
+    ranges = []
+    for frame_id, template_id in zip(frame_ids, classes):
+        if template_id is None:
+            continue
+        if ranges and ranges[-1][1] + step == frame_id and ranges[-1][2] == template_id:
+            ranges[-1][1] = frame_id
+        else:
+            ranges.append([frame_id, frame_id, template_id])
+
+    return ranges
+
+
+def _score_video_segment(task):
+    '''
+    Decodes the frames [start, end) of the video (every step-th one) and scores their scorebug ROIs.
+    The frames with the score above the threshold are written to dst_dir (if it's given)
+    '''
+    video_path, start, end, step, bank, threshold, dst_dir = task
+    x1, y1, x2, y2 = bank.roi
+    frame_ids, scores, template_ids = [], [], []
+
+    video_cap = cv2.VideoCapture(video_path)
+    video_cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    for frame_id in range(start, end):
+        # Skip the frames between the samples without decoding them to BGR:
+        if (frame_id - start) % step != 0:
+            if not video_cap.grab():
+                break
+            continue
+        ok, frame = video_cap.read()
+        if not ok:
+            break
+        img = cv2.cvtColor(frame[y1:y2, x1:x2], cv2.COLOR_BGR2GRAY)
+        score, best = bank.score([crop[None] for crop in bank.crop_rois(img)])
+        if dst_dir is not None and score[0] > threshold:
+            cv2.imwrite(os.path.join(dst_dir, get_video_frame_name(frame_id)), frame)
+        frame_ids.append(frame_id)
+        scores.append(float(score[0]))
+        template_ids.append(bank.ids[best[0]])
+    video_cap.release()
+
+    return frame_ids, scores, template_ids
+
+
+def get_video_frames_with_scorebug(video_path, data_dir, threshold=0.4, num_workers=None, recompute=False,
+                                   step=1, save_frames=False, segment_len=1000):
+    '''
+    Scores the scorebug ROI of the video frames on the fly (without extracting all the frames first).
+    The video is split into segments of segment_len frames decoded by parallel processes.
+    Writes the ranges of the frames with the scorebug (in frame ids and seconds) and, if save_frames
+    is set, the kept frames themselves to frames_target
+    '''
+    target_dir = os.path.join(data_dir, 'frames_target') if save_frames else None
+    scores_path = os.path.join(data_dir, VIDEO_SCORES_FILE_NAME)
+    ranges_path = os.path.join(data_dir, RANGES_FILE_NAME)
+    if target_dir is not None and not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+
+    video_cap = cv2.VideoCapture(video_path)
+    num_frames = int(video_cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = video_cap.get(cv2.CAP_PROP_FPS)
+    video_cap.release()
+    assert num_frames > 0, 'Cannot read {}'.format(video_path)
+
+    # Score the frames (the saved scores are enough unless the frames have to be written):
+    bank = TemplateBank(data_dir)
+    params = get_bank_params(bank, video=os.path.basename(video_path), step=step)
+    scores, template_ids = ({}, {}) if recompute or save_frames else load_scorebug_scores(scores_path, params)
+    if not scores:
+        segment_len = max(segment_len // step, 1) * step
+        tasks = [(video_path, start, min(start + segment_len, num_frames), step, bank, threshold, target_dir)
+                 for start in range(0, num_frames, segment_len)]
+        with tqdm(total=num_frames, desc=f'Scoring', unit='frame') as pbar, \
+                ProcessPoolExecutor(max_workers=num_workers) as pool:
+            for task, (frame_ids, segment_scores, segment_ids) in zip(tasks, pool.map(_score_video_segment, tasks)):
+                segment_names = [get_video_frame_name(i) for i in frame_ids]
+                scores.update(zip(segment_names, segment_scores))
+                template_ids.update(zip(segment_names, segment_ids))
+                pbar.update(task[2] - task[1])
+        save_scorebug_scores(scores_path, params, scores, template_ids)
+
+    frame_ids = sorted(int(name.split('-')[-1].split('.')[0]) for name in scores)
+    names = [get_video_frame_name(i) for i in frame_ids]
+    classes = [template_ids[name] if scores[name] > threshold else None for name in names]
+    keep = [template_id is not None for template_id in classes]
+    ranges = get_scorebug_ranges(frame_ids, classes, step)
+    output = {
+        'source': 'video',
+        'video': os.path.basename(video_path),
+        'fps': fps,
+        'num_frames': num_frames,
+        'step': step,
+        'threshold': threshold,
+        'ranges': ranges,
+        'times': [[start / fps, (end + 1) / fps] for start, end, _ in ranges] if fps > 0 else []
+    }
+    with open(ranges_path, 'w') as f:
+        json.dump(output, f, indent=2)
+
+    print ('Done! Target frames: {}, dropped frames: {}, ranges: {}'.format(
+        sum(keep), len(keep) - sum(keep), len(ranges)))
+
+
+def get_args():
+    parser = argparse.ArgumentParser('Splits the frames of a game into the ones with the scorebug and the rest')
+    parser.add_argument('data_dir', help='Game directory containing frames/ (or the outputs) and scorebug_templates/')
+    parser.add_argument('--threshold', type=float, default=0.4, help='Min SSIM of a frame with the scorebug')
+    parser.add_argument('--workers', type=int, default=None, help='Number of scoring processes')
+    parser.add_argument('--recompute', action='store_true',
+                        help='Recompute the scores even if they have been saved by the previous run')
+    parser.add_argument('--decoder', default='cv2', choices=list(ROI_DECODERS.keys()),
+                        help='Decoder of the scorebug ROI')
+    parser.add_argument('--full_decode', action='store_true',
+                        help='Decode the frames at the full resolution')
+    parser.add_argument('--mode', default='copy', choices=PARTITION_MODES,
+                        help='How the frames are placed into frames_target / frames_dropped '
+                             '(manifest - only the list of the frames is written)')
+    parser.add_argument('--video', default=None,
+                        help='Score the frames of this video on the fly instead of the extracted frames')
+    parser.add_argument('--step', type=int, default=1, help='Score every step-th frame of the video')
+    parser.add_argument('--save_frames', action='store_true',
+                        help='Write the kept frames of the video (otherwise only their ranges are written)')
+    parser.add_argument('--intervals', action='store_true',
+                        help='Find the intervals of the frames with the scorebug by sampling and bisection '
+                             '(the frames are not partitioned)')
+    parser.add_argument('--sample_step', type=int, default=50,
+                        help='Sampling step of the interval search (the min length of a detected change)')
+    parser.add_argument('--benchmark', type=int, default=None,
+                        help='Benchmark the batched SSIM against skimage on this number of frames')
+    parser.add_argument('--template_img', default=None,
+                        help='Select the scorebug template on this frame instead of filtering the frames')
+    parser.add_argument('--template_id', default='template',
+                        help='Name of the template selected with --template_img (one per scorebug layout)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.template_img is not None:
+        prepare_scorebug_template(args.template_img, os.path.join(args.data_dir, 'scorebug_templates'),
+                                  args.template_id)
+    elif args.benchmark is not None:
+        benchmark_ssim(args.data_dir, args.benchmark)
+    elif args.intervals:
+        find_scorebug_intervals(args.data_dir, args.threshold, args.workers, args.recompute,
+                                args.decoder, not args.full_decode, args.sample_step)
+    elif args.video is not None:
+        get_video_frames_with_scorebug(args.video, args.data_dir, args.threshold, args.workers, args.recompute,
+                                       args.step, args.save_frames)
+    else:
+        get_frames_with_scorebug(args.data_dir, args.threshold, args.workers, args.recompute,
+                                 args.decoder, not args.full_decode, args.mode)
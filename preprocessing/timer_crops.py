@@ -0,0 +1,235 @@
+import os
+import cv2
+import json
+import bisect
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+
+from ocr.crop_atlas import ATLAS_INDEX_NAME, DEFAULT_ATLAS_WIDTH, list_crops, get_source_signature, resize_crop, \
+    write_atlas, pack_atlas
+from preprocessing.preprocessing import RANGES_FILE_NAME, INTERVALS_FILE_NAME, MANIFEST_FILE_NAME, \
+    get_video_frame_name, list_frames
+
+# The folders the OCR tool reads (see run_ocr_tool.py):
+TIMERS_FOLDER = 'timers'
+ATLAS_FOLDER = 'timers_atlas'
+PREDS_FOLDER = 'timer_preds'
+PREDS_NAME = 'preds.json'
+
+# Outputs of the scorebug filter listing the extracted frames with the scorebug:
+FRAME_SOURCES = {'manifest': MANIFEST_FILE_NAME, 'intervals': INTERVALS_FILE_NAME}
+
+
+def select_timer_roi(game_dir, template_id='template'):
+    '''
+    Selects the timer area on the scorebug of the template and saves it to the template meta
+    (relative to the scorebug ROI, so it follows the template)
+    '''
+    meta_path = os.path.join(game_dir, 'scorebug_templates', template_id + '.json')
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    img = cv2.imread(os.path.join(game_dir, 'scorebug_templates', meta['img_name']), 1)
+    scorebug = img[meta['y']:meta['y'] + meta['h'], meta['x']:meta['x'] + meta['w']]
+
+    x, y, w, h = cv2.selectROI('Timer of \'{}\''.format(template_id), scorebug)
+    cv2.destroyAllWindows()
+    if w == 0 or h == 0:
+        return
+    meta['timer'] = {'x': x, 'y': y, 'w': w, 'h': h}
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    print(meta)
+
+
+def load_timer_rois(game_dir):
+    ''' Returns {template id: timer ROI (x1, y1, x2, y2) in the frame} '''
+    templates_dir = os.path.join(game_dir, 'scorebug_templates')
+    rois = {}
+    for file in sorted(os.listdir(templates_dir)):
+        if not file.endswith('.json'):
+            continue
+        with open(os.path.join(templates_dir, file), 'r') as f:
+            meta = json.load(f)
+        if 'timer' not in meta:
+            continue
+        x1, y1 = meta['x'] + meta['timer']['x'], meta['y'] + meta['timer']['y']
+        rois[file[:-len('.json')]] = (x1, y1, x1 + meta['timer']['w'], y1 + meta['timer']['h'])
+
+    return rois
+
+
+def _save_crop(img, roi, dst_path, width):
+    ''' Writes the timer crop of the frame and returns it resized for the atlas '''
+    x1, y1, x2, y2 = roi
+    crop = img[y1:y2, x1:x2]
+    cv2.imwrite(dst_path, crop)
+
+    return resize_crop(crop, width)
+
+
+def _crop_frames(task):
+    ''' Crops the timers of the extracted frames '''
+    items, dst_dir, width = task
+    crops = []
+    for img_path, name, roi in items:
+        img = cv2.imread(img_path, cv2.IMREAD_COLOR)
+        crops.append(_save_crop(img, roi, os.path.join(dst_dir, name), width) if img is not None else None)
+
+    return crops
+
+
+def _crop_video_range(task):
+    ''' Crops the timers of the frames [start, end] of the video (every step-th one) '''
+    video_path, start, end, step, roi, dst_dir, width = task
+    crops = []
+
+    video_cap = cv2.VideoCapture(video_path)
+    video_cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    for frame_id in range(start, end + 1):
+        if (frame_id - start) % step != 0:
+            video_cap.grab()
+            continue
+        ok, frame = video_cap.read()
+        crops.append(_save_crop(frame, roi, os.path.join(dst_dir, get_video_frame_name(frame_id)), width)
+                     if ok else None)
+    video_cap.release()
+
+    return crops
+
+
+def get_frame_items(game_dir, timer_rois, source=None):
+    '''
+    Returns the (frame path, crop name, timer ROI) of the extracted frames with the scorebug
+    from the manifest or the intervals of the scorebug filter (see FRAME_SOURCES).
+    If source is None, the newest of them is taken
+    '''
+    if source is None:
+        existing = [s for s, file in FRAME_SOURCES.items() if os.path.isfile(os.path.join(game_dir, file))]
+        assert existing, 'No scorebug filter outputs in {}'.format(game_dir)
+        source = max(existing, key=lambda s: os.path.getmtime(os.path.join(game_dir, FRAME_SOURCES[s])))
+    with open(os.path.join(game_dir, FRAME_SOURCES[source]), 'r') as f:
+        meta = json.load(f)
+
+    # (the frames may have been moved to frames_target by the scorebug filter)
+    paths, names = list_frames(game_dir)
+    if source == 'manifest':
+        kept = meta['target']
+    else:
+        # The intervals are taken by the names of their first and last frames:
+        kept = []
+        for (start_name, end_name), (_, _, template_id) in zip(meta['names'], meta['ranges']):
+            start, end = bisect.bisect_left(names, start_name), bisect.bisect_right(names, end_name)
+            kept.extend([name, template_id] for name in names[start:end])
+    name_to_path = dict(zip(names, paths))
+
+    return [(name_to_path[name], name, timer_rois[template_id])
+            for name, template_id in kept if template_id in timer_rois and name in name_to_path]
+
+
+def extract_timer_crops(game_dir, ocr_dir, name, video_path=None, width=DEFAULT_ATLAS_WIDTH,
+                        num_workers=None, chunk_size=256, segment_len=1000, source=None):
+    '''
+    Crops the timers of the frames with the scorebug (the timer ROI is taken from the best matching
+    template of every frame) in parallel processes and writes them to the OCR tool's folders:
+    the crops, their packed atlas and an empty predictions skeleton.
+    If video_path is given, the frames of the scorebug ranges are decoded from the video
+    (the ranges must have been found on this video), otherwise the extracted frames listed by
+    the source (see get_frame_items()) are read
+    '''
+    timer_rois = load_timer_rois(game_dir)
+    assert timer_rois, 'No timer ROIs in the templates of {}, select them with --select_timer'.format(game_dir)
+    dst_dir = os.path.join(ocr_dir, TIMERS_FOLDER, name)
+    atlas_dir = os.path.join(ocr_dir, ATLAS_FOLDER, name)
+    preds_path = os.path.join(ocr_dir, PREDS_FOLDER, name, PREDS_NAME)
+    for dir_path in (dst_dir, os.path.dirname(preds_path)):
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+
+    if video_path is not None:
+        with open(os.path.join(game_dir, RANGES_FILE_NAME), 'r') as f:
+            ranges_meta = json.load(f)
+        assert ranges_meta.get('source', 'video') == 'video' and 'step' in ranges_meta, \
+            'The ranges of {} have not been found on a video (use --video of the scorebug filter)'.format(game_dir)
+        step = ranges_meta['step']
+        tasks, names = [], []
+        for start, end, template_id in ranges_meta['ranges']:
+            if template_id not in timer_rois:
+                continue
+            names.extend(get_video_frame_name(i) for i in range(start, end + 1, step))
+            # Long ranges are split into segments decoded in parallel:
+            for s in range(start, end + 1, segment_len * step):
+                tasks.append((video_path, s, min(s + segment_len * step - 1, end), step,
+                              timer_rois[template_id], dst_dir, width))
+        func = _crop_video_range
+    else:
+        items = get_frame_items(game_dir, timer_rois, source)
+        names = [crop_name for _, crop_name, _ in items]
+        tasks = [(items[i:i + chunk_size], dst_dir, width) for i in range(0, len(items), chunk_size)]
+        func = _crop_frames
+
+    def crops():
+        with tqdm(total=len(names), desc=f'Cropping', unit='img') as pbar, \
+                ProcessPoolExecutor(max_workers=num_workers) as pool:
+            for task_crops in pool.map(func, tasks):
+                pbar.update(len(task_crops))
+                yield from task_crops
+
+    # The atlas is written while the crops are coming (in the order of the names):
+    assert names == sorted(names), 'The crops must come in the order of their names'
+    write_atlas(atlas_dir, names, crops(), width, None)
+
+    # The signature can only be computed when the crops are written:
+    crop_names = list_crops(dst_dir)
+    if crop_names == names:
+        index_path = os.path.join(atlas_dir, ATLAS_INDEX_NAME)
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        index['signature'] = get_source_signature(dst_dir, names)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(index_path + '.tmp', index_path)
+    else:
+        # There are crops of the previous runs in the folder:
+        pack_atlas(dst_dir, atlas_dir, width, num_workers)
+
+    # Empty predictions of the new crops, so they can be annotated from scratch:
+    preds = {}
+    if os.path.isfile(preds_path):
+        with open(preds_path, 'r') as f:
+            preds = json.load(f)
+    new_names = [crop_name for crop_name in crop_names if crop_name not in preds]
+    if new_names or not os.path.isfile(preds_path):
+        preds.update((crop_name, {'text': None}) for crop_name in new_names)
+        with open(preds_path + '.tmp', 'w') as f:
+            json.dump(preds, f, indent=2)
+        os.replace(preds_path + '.tmp', preds_path)
+
+    print('Done! Timer crops: {} -> {}'.format(len(names), dst_dir))
+
+
+def get_args():
+    parser = argparse.ArgumentParser('Crops the timers of the frames with the scorebug for the OCR tool')
+    parser.add_argument('game_dir', help='Game directory containing scorebug_templates/ and the scorebug filter '
+                                         'outputs (the manifest or the intervals of the frames, or the video ranges)')
+    parser.add_argument('ocr_dir', help='Data directory of the OCR tool')
+    parser.add_argument('name', help='Name of the game in the OCR data directory')
+    parser.add_argument('--video', default=None, help='Crop the frames of the scorebug ranges from this video')
+    parser.add_argument('--source', default=None, choices=list(FRAME_SOURCES.keys()),
+                        help='Output of the scorebug filter listing the extracted frames (the newest by default)')
+    parser.add_argument('--width', type=int, default=DEFAULT_ATLAS_WIDTH,
+                        help='Width of the crops in the atlas (the native size by default)')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes')
+    parser.add_argument('--select_timer', default=None, metavar='TEMPLATE_ID',
+                        help='Select the timer area of the template instead of cropping')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.select_timer is not None:
+        select_timer_roi(args.game_dir, args.select_timer)
+    else:
+        extract_timer_crops(args.game_dir, args.ocr_dir, args.name, args.video, args.width, args.workers,
+                            source=args.source)
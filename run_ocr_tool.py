@@ -5,6 +5,9 @@ from ocr.annotator import OCRTimerAnnotator
 from ui.confirmation import display_confirmation
 
 DEFAULT_FRAMES_FOLDER = 'timers'
+DEFAULT_ATLAS_FOLDER = 'timers_atlas'
+DEFAULT_HASHES_FOLDER = 'timers_hashes'
+DEFAULT_HASHES_NAME = 'hashes.json'
 DEFAULT_PREDS_FOLDER= 'timer_preds'
 DEFAULT_PREDS_NAME='preds.json'
 DEFAULT_OUTPUT_FOLDER='manual_anno'
@@ -19,6 +22,17 @@ def get_args():
                         help='Data source. Must contain frames and preds folders')
     parser.add_argument('name',
                         help='Name of a specific game from data_dir')
+    parser.add_argument('--atlas', action='store_true',
+                        help='Read the crops from the packed atlas instead of the image files')
+    parser.add_argument('--review', action='store_true',
+                        help='Walk only the frames which texts are inconsistent with the timer countdown')
+    parser.add_argument('--max_step', type=float, default=None,
+                        help='Max allowed decrease of the timer between consecutive frames (in seconds), '
+                             'used with --review')
+    parser.add_argument('--group', action='store_true',
+                        help='Apply a text to the whole run of near-identical consecutive crops')
+    parser.add_argument('--group_distance', type=int, default=0,
+                        help='Max Hamming distance between the perceptual hashes of near-identical crops')
     return parser.parse_args()
 
 def get_paths(data_dir, name):
@@ -27,8 +41,10 @@ def get_paths(data_dir, name):
     output_dir = os.path.join(data_dir, DEFAULT_OUTPUT_FOLDER, name)
     output_path = os.path.join(output_dir, DEFAULT_OUTPUT_NAME)
     temp_path = os.path.join(output_dir, DEFAULT_TEMP_FILE_SUFFIX + DEFAULT_OUTPUT_NAME)
+    atlas_dir = os.path.join(data_dir, DEFAULT_ATLAS_FOLDER, name)
+    hashes_path = os.path.join(data_dir, DEFAULT_HASHES_FOLDER, name, DEFAULT_HASHES_NAME)
 
-    return img_dir, preds_path, output_dir, output_path, temp_path
+    return img_dir, preds_path, output_dir, output_path, temp_path, atlas_dir, hashes_path
 
 
 def load(mapper, path):
@@ -58,14 +74,18 @@ def run_annotating():
     args = get_args()
 
     # Get paths:
-    img_dir, preds_path, output_dir, output_path, temp_path = get_paths(args.data_dir, args.name)
+    img_dir, preds_path, output_dir, output_path, temp_path, atlas_dir, hashes_path = \
+        get_paths(args.data_dir, args.name)
+    if not args.atlas:
+        atlas_dir = None
     assert os.path.isdir(img_dir) and os.path.isfile(preds_path), '{} {}'.format(img_dir, preds_path)
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     # Create mapping:
     try:
-        annotator = OCRTimerAnnotator(img_dir, preds_path, output_path, UI_CANVAS_SIZE, temp_path=temp_path)
+        annotator = OCRTimerAnnotator(img_dir, preds_path, output_path, UI_CANVAS_SIZE, temp_path=temp_path,
+                                      atlas_dir=atlas_dir)
 
     except IOError as e:
         print(str(e))
@@ -80,6 +100,16 @@ def run_annotating():
         if not restore(annotator, temp_path):
             os.remove(temp_path)
 
+    # Group near-identical crops:
+    if args.group:
+        num_groups = annotator.group_similar_crops(img_dir, hashes_path, args.group_distance)
+        print('Groups of near-identical crops: {}'.format(num_groups))
+
+    # Review the suspicious frames only:
+    if args.review:
+        num_suspicious = annotator.review_anomalies(args.max_step)
+        print('Suspicious frames to review: {}'.format(num_suspicious))
+
     # Run mapping:
     try:
         annotator.run()
@@ -90,6 +120,8 @@ def run_annotating():
         save(annotator, output_path)
         print('Manual points mapping is interrupted!')
 
+    # Wait for the pending writes:
+    annotator.close()
     if os.path.isfile(temp_path):
         os.remove(temp_path)
 
@@ -75,6 +75,9 @@ def run_annotator(data_dir):
         save(annotator, output_path)
         print('Annotating is interrupted!')
 
+    # Wait for the pending writes:
+    annotator.close()
+
     if os.path.isfile(temp_path):
         os.remove(temp_path)
 
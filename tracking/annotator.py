@@ -11,7 +11,7 @@ class State(Enum):
 
 class TrackingAnnotator:
     def __init__(self, clip_paths, output_path, temp_path=None, canvas_size=(1920,1080)):
-        self.data = DataProcessor(clip_paths)
+        self.data = DataProcessor(clip_paths, journal_path=temp_path)
         self.ui_renderer = UIRenderer('Manual Tracks Editing', canvas_size)
         self.output_path = output_path
         self.temp_path = temp_path
@@ -43,7 +43,7 @@ class TrackingAnnotator:
         # Handle keyboard events:
         while True:
             if self.ui_renderer.is_window_visible() == False:
-                self.save()
+                self.save(wait=False)
                 self.ui_renderer.set_saved_counter(30)
                 return False
 
@@ -81,16 +81,22 @@ class TrackingAnnotator:
                 self.ui_renderer.set_saved_counter()
                 break
             elif key == ord('s'):   # save -> clean text
-                self.save()
+                self.save(wait=False)
                 self.ui_renderer.set_saved_counter(30)
                 print('Data has been saved to {}!'.format(self.output_path))
                 break
             elif key == ord('f'):    # set frame state to false
-                self.data.get_clip().set_frame_anno(key='label', value=False)
-                self.data.get_clip().set_frame_anno(key='pos', value=None)  # unset a player position
+                self.data.set_frame_anno(key='label', value=False)
+                self.data.set_frame_anno(key='pos', value=None)  # unset a player position
                 break
             elif key == ord('t'):    # set frame state to true
-                self.data.get_clip().set_frame_anno(key='label', value=True)
+                self.data.set_frame_anno(key='label', value=True)
+                break
+            elif key == ord('k'):    # enable / disable the keyframe editing mode
+                self.data.toggle_keyframe_mode()
+                break
+            elif key == ord('i'):    # switch the interpolation method (linear / spline)
+                self.data.toggle_interpolation()
                 break
 
             # Play:
@@ -112,6 +118,9 @@ class TrackingAnnotator:
             'num_clips': len(self.data),
             'frame_label': clip.get_frame_anno()['label'],
             'player_pos': clip.get_frame_anno()['pos'],
+            'anno_type': clip.get_frame_anno_type(),
+            'keyframe_mode': self.data.keyframe_mode,
+            'interpolation': self.data.interpolation,
             'cur_clip_name': clip.name,
             'prev_clip_name': self.data.get_clip(cur_clip_id - 1).name if cur_clip_id > 0 else 'None',
             'next_clip_name': self.data.get_clip(cur_clip_id + 1).name if cur_clip_id + 1 < len(self.data) else 'None'
@@ -119,20 +128,22 @@ class TrackingAnnotator:
 
         return data
 
-    def save(self, dst_path=None):
+    def save(self, dst_path=None, wait=True):
         if dst_path is None:
             dst_path = self.output_path
         if self.data:
-            self.data.save(dst_path)
+            self.data.save(dst_path, wait=wait)
 
     def load(self, path):
         assert self.data is not None
         self.data.load(path)
 
     def restore(self, path):
-        raise NotImplementedError
-        # assert self.data is not None
-        # self.data.restore(path)
+        assert self.data is not None
+        self.data.restore(path)
+
+    def close(self):
+        self.data.close()
 
 
     ''' Handler functions '''
@@ -150,14 +161,14 @@ class TrackingAnnotator:
             # Set a new player position:
             if self.data.get_clip().get_frame_anno()['label']:
                 x, y = self.normalize_coords(x, y, self.ui_renderer.frame_layer_pos)
-                self.data.get_clip().set_frame_anno(key='pos', value=(x,y))
+                self.data.set_frame_anno(key='pos', value=(x,y))
 
         self.ui_renderer.render(self._make_rendering_data())
 
     def mouse_right_click_handler(self, x, y):
         if self.check_hit(x, y, self.ui_renderer.frame_layer_pos):
             # Unset a player position:
-            self.data.get_clip().set_frame_anno(key='pos', value=None)
+            self.data.set_frame_anno(key='pos', value=None)
 
         self.ui_renderer.render(self._make_rendering_data())
 
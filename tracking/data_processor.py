@@ -1,7 +1,11 @@
 import cv2
 import json
+import numpy as np
 from pathlib import PurePath
 
+from ui.async_writer import AsyncWriter
+from tracking.video_decoder import DecoderPool
+
 
 class DPClip:
     ''' Represents a video clip'''
@@ -11,25 +15,229 @@ class DPClip:
         self.name = PurePath(path).parts[-1]
         self.current_frame_id = 0
         self.num_frames = int(cv2.VideoCapture(path).get(cv2.CAP_PROP_FRAME_COUNT))
-        self.annos = {i: {'label': True, 'pos': None} for i in range(self.num_frames)}
 
-    def get_frame_anno(self):
-        return self.annos[self.current_frame_id]
+        # Per-frame annotations (all frames are 'true' and unset by default):
+        self.labels = np.ones(self.num_frames, dtype=bool)
+        self.positions = np.full((self.num_frames, 2), np.nan, dtype=np.float32)
+        self.keyframes = np.zeros(self.num_frames, dtype=bool)
+        self.interpolated = np.zeros(self.num_frames, dtype=bool)
+
+    def get_frame_anno(self, frame_id=None):
+        if frame_id is None:
+            frame_id = self.current_frame_id
+        pos = self.positions[frame_id]
+        if np.isnan(pos[0]):
+            pos = None
+        else:
+            pos = (float(pos[0]), float(pos[1]))
+
+        return {'label': bool(self.labels[frame_id]), 'pos': pos}
+
+    def set_frame_anno(self, key, value, frame_id=None):
+        if frame_id is None:
+            frame_id = self.current_frame_id
+        if key == 'label':
+            self.labels[frame_id] = value
+        elif key == 'pos':
+            self.positions[frame_id] = (np.nan, np.nan) if value is None else value
+            self.keyframes[frame_id] = False
+            self.interpolated[frame_id] = False
+        else:
+            raise KeyError(key)
+
+    def get_frame_anno_type(self, frame_id=None):
+        if frame_id is None:
+            frame_id = self.current_frame_id
+        if self.keyframes[frame_id]:
+            return 'keyframe'
+        elif self.interpolated[frame_id]:
+            return 'interpolated'
+        return None
+
+    def set_keyframe(self, pos, frame_id=None, method='linear'):
+        '''
+        Sets the player position as a keyframe (or unsets the keyframe if pos is None)
+        and updates the interpolated positions around it.
+        Returns ids of the frames that have been changed
+        '''
+        if frame_id is None:
+            frame_id = self.current_frame_id
+        if pos is None:
+            self.positions[frame_id] = (np.nan, np.nan)
+            self.keyframes[frame_id] = False
+        else:
+            self.positions[frame_id] = pos
+            self.labels[frame_id] = True
+            self.keyframes[frame_id] = True
+        self.interpolated[frame_id] = False
 
-    def set_frame_anno(self, key, value):
-        self.annos[self.current_frame_id][key] = value
+        return self.interpolate(frame_id, method)
+
+    def interpolate(self, frame_id=None, method='linear'):
+        '''
+        Recomputes the positions between the keyframes affected by a change at frame_id:
+        the neighbouring segments for the linear interpolation and two segments on both sides
+        for the spline (Catmull-Rom) one. Frames labeled as 'false' and frames whose positions
+        have been set manually are not touched.
+        Returns ids of the frames that have been changed
+        '''
+        if frame_id is None:
+            frame_id = self.current_frame_id
+        assert method in ('linear', 'spline')
+        keyframe_ids = np.flatnonzero(self.keyframes)
+        margin = 1 if method == 'linear' else 2
+
+        # Range of the affected frames:
+        start, stop = frame_id, frame_id
+        if len(keyframe_ids) > 0:
+            k = np.searchsorted(keyframe_ids, frame_id)
+            start = min(start, keyframe_ids[max(k - margin, 0)])
+            stop = max(stop, keyframe_ids[min(k + margin, len(keyframe_ids) - 1)])
+        frame_ids = np.arange(start, stop + 1)
+
+        # Clear the previous interpolation:
+        changed = self.interpolated[start:stop+1].copy()
+        self.positions[start:stop+1][changed] = np.nan
+        self.interpolated[start:stop+1] = False
+
+        # Frames between the keyframes to be filled:
+        if len(keyframe_ids) > 1:
+            frames = frame_ids[(frame_ids > keyframe_ids[0]) & (frame_ids < keyframe_ids[-1])]
+            frames = frames[self.labels[frames] &
+                            ~self.keyframes[frames] &
+                            np.isnan(self.positions[frames, 0])]
+        else:
+            frames = frame_ids[:0]
+
+        if len(frames) > 0:
+            seg = np.searchsorted(keyframe_ids, frames, side='right') - 1
+            k1, k2 = keyframe_ids[seg], keyframe_ids[seg + 1]
+            p1, p2 = self.positions[k1], self.positions[k2]
+            t = ((frames - k1) / (k2 - k1)).astype(np.float32)[:, None]
+
+            if method == 'linear':
+                pos = p1 + (p2 - p1) * t
+            else:
+                p0 = self.positions[keyframe_ids[np.maximum(seg - 1, 0)]]
+                p3 = self.positions[keyframe_ids[np.minimum(seg + 2, len(keyframe_ids) - 1)]]
+                pos = 0.5 * (2 * p1 +
+                             (p2 - p0) * t +
+                             (2 * p0 - 5 * p1 + 4 * p2 - p3) * t ** 2 +
+                             (3 * p1 - p0 - 3 * p2 + p3) * t ** 3)
+
+            self.positions[frames] = pos
+            self.interpolated[frames] = True
+            changed[frames - start] = True
+
+        changed[frame_id - start] = True
+
+        return frame_ids[changed]
+
+    def get_edited_frame_ids(self):
+        ''' Returns ids of the frames that differ from the default annotation '''
+        return np.flatnonzero(~self.labels | ~np.isnan(self.positions[:, 0]))
+
+    def get_annos(self, frame_ids=None):
+        '''
+        Returns annotations in a sparse form. By default only the edited frames are taken,
+        otherwise the annotations of the given frames are returned as they are
+        '''
+        if frame_ids is None:
+            frame_ids = self.get_edited_frame_ids()
+        frame_ids = np.asarray(frame_ids, dtype=np.int64)
+        labels = self.labels[frame_ids].tolist()
+        positions = self.positions[frame_ids].astype(np.float64)
+        is_set = (~np.isnan(positions[:, 0])).tolist()
+        positions = np.round(positions, 6).tolist()
+
+        keyframes = self.keyframes[frame_ids].tolist()
+        interpolated = self.interpolated[frame_ids].tolist()
+
+        annos = {}
+        for i, frame_id in enumerate(frame_ids.tolist()):
+            if labels[i] and is_set[i]:
+                anno = {'label': True, 'pos': positions[i]}
+                if keyframes[i]:
+                    anno['keyframe'] = True
+                elif interpolated[i]:
+                    anno['interpolated'] = True
+            else:
+                anno = {'label': labels[i]}
+            annos[str(frame_id).zfill(6)] = anno
+
+        return annos
+
+    def set_annos(self, annos):
+        ''' Fills the frame annotations from their sparse form (see get_annos) '''
+        if len(annos) == 0:
+            return
+        frame_ids = np.fromiter((int(k) for k in annos.keys()), dtype=np.int64, count=len(annos))
+        assert frame_ids.min() >= 0 and frame_ids.max() < self.num_frames
+        labels, positions, keyframes, interpolated = DPClip.annos_to_arrays(list(annos.values()))
+
+        self.labels[frame_ids] = labels
+        self.positions[frame_ids] = positions
+        self.keyframes[frame_ids] = keyframes
+        self.interpolated[frame_ids] = interpolated
+
+    def bind_storage(self, labels, positions, keyframes, interpolated):
+        ''' Moves the annotations into the given arrays (e.g. views of the arrays shared by all clips) '''
+        labels[:] = self.labels
+        positions[:] = self.positions
+        keyframes[:] = self.keyframes
+        interpolated[:] = self.interpolated
+        self.labels, self.positions = labels, positions
+        self.keyframes, self.interpolated = keyframes, interpolated
+
+    @staticmethod
+    def annos_to_arrays(annos):
+        ''' Converts a list of frame annotations to the arrays of labels, positions and flags '''
+        num = len(annos)
+        labels = np.fromiter((a['label'] for a in annos), dtype=bool, count=num)
+        positions = np.array([a.get('pos') or (np.nan, np.nan) for a in annos], dtype=np.float32)
+        positions = positions.reshape(num, 2)
+        keyframes = np.fromiter((a.get('keyframe', False) for a in annos), dtype=bool, count=num)
+        interpolated = np.fromiter((a.get('interpolated', False) for a in annos), dtype=bool, count=num)
+
+        return labels, positions, keyframes, interpolated
 
 
 class DataProcessor:
     ''' Loads, prepares and manages data (video clips and editing results) '''
 
-    def __init__(self, clip_paths):
+    def __init__(self, clip_paths, journal_path=None):
         self.clips = []
+        self.name_to_idx_map = {}
         for path in clip_paths:
             self.clips.append(DPClip(path))
+            self.name_to_idx_map[self.clips[-1].name] = len(self.clips) - 1
+
+        # All clips keep their annotations in views of the same arrays (to fill them at once on loading):
+        num_frames = [clip.num_frames for clip in self.clips]
+        self.clip_offsets = np.concatenate(([0], np.cumsum(num_frames))).astype(np.int64)
+        total_frames = int(self.clip_offsets[-1])
+        self.labels = np.ones(total_frames, dtype=bool)
+        self.positions = np.full((total_frames, 2), np.nan, dtype=np.float32)
+        self.keyframes = np.zeros(total_frames, dtype=bool)
+        self.interpolated = np.zeros(total_frames, dtype=bool)
+        for clip, start, stop in zip(self.clips, self.clip_offsets[:-1], self.clip_offsets[1:]):
+            clip.bind_storage(self.labels[start:stop], self.positions[start:stop],
+                              self.keyframes[start:stop], self.interpolated[start:stop])
+
         self.current_clip_id = 0
         self.open_clip_id = -1
-        self.video_cap = None
+        self.decoder = None
+        self.keyframe_mode = False
+        self.interpolation = 'linear'
+        self.decoder_pool = DecoderPool(max_size=4)
+
+        # Saving state (all the writes are done in a background thread):
+        self.writer = AsyncWriter()
+        self.journal_path = journal_path
+        self.dirty_clip_ids = set(range(len(self.clips)))
+        self.clip_chunks = {}
+        self.missing_clip_chunks = {}   # loaded clips that are not in the current data
+        self.saved_path = None
 
     def __len__(self):
         return len(self.clips)
@@ -40,6 +248,7 @@ class DataProcessor:
         '''
         if self.open_clip_id != self.current_clip_id:
             self._open_video()
+            self._prefetch_adjacent_clips()
 
         frame = self._read_frame()
 
@@ -90,37 +299,130 @@ class DataProcessor:
 
         return clip.current_frame_id
 
-    def save(self, dst_path):
-        output = {}
-        for clip in self.clips:
-            clip_output = {}
-            for frame_id, frame_anno in clip.annos.items():
-                if frame_anno['label'] == False:
-                    clip_output[str(frame_id).zfill(6)] = {'label': False}
-                elif frame_anno['pos'] is not None:
-                    clip_output[str(frame_id).zfill(6)] = {'label': True, 'pos': frame_anno['pos']}
-            output[clip.name] = clip_output
-
-        with open(dst_path, 'w') as file:
-            json.dump(output, file, indent=2)
-
-    def load(self, path):
+    def set_frame_anno(self, key, value):
+        ''' Edits the current frame of the current clip and journals the change '''
+        clip = self.clips[self.current_clip_id]
+        frame_id = clip.current_frame_id
+
+        if key == 'pos' and (self.keyframe_mode or clip.keyframes[frame_id]):
+            frame_ids = clip.set_keyframe(value, method=self.interpolation)
+        else:
+            clip.set_frame_anno(key, value)
+            frame_ids = [frame_id]
+            if key == 'label' and self.keyframe_mode:
+                frame_ids = clip.interpolate(method=self.interpolation)
+
+        self._on_frames_changed(self.current_clip_id, frame_ids)
+
+    def toggle_keyframe_mode(self):
+        self.keyframe_mode = not self.keyframe_mode
+        return self.keyframe_mode
+
+    def toggle_interpolation(self):
+        self.interpolation = 'spline' if self.interpolation == 'linear' else 'linear'
+        return self.interpolation
+
+    def _on_frames_changed(self, clip_id, frame_ids):
+        self.dirty_clip_ids.add(clip_id)
+
+        if self.journal_path is not None:
+            clip = self.clips[clip_id]
+            line = json.dumps({clip.name: clip.get_annos(frame_ids)})
+            self.writer.append(self.journal_path, line + '\n')
+
+    def save(self, dst_path, wait=True):
+        '''
+        Saves the results to json. Only the clips changed since the previous save are serialized again,
+        the file itself is written in the background (unless wait is set)
+        '''
+        if not self.dirty_clip_ids and dst_path == self.saved_path:
+            if wait:
+                self.writer.flush()
+            return
+
+        for clip_id in self.dirty_clip_ids:
+            clip = self.clips[clip_id]
+            # The clip's part of the output (as json.dump(output, indent=2) would format it):
+            self.clip_chunks[clip_id] = json.dumps({clip.name: clip.get_annos()}, indent=2)[2:-2]
+        self.dirty_clip_ids.clear()
+
+        chunks = [self.clip_chunks[i] for i in range(len(self.clips))]
+        chunks += self.missing_clip_chunks.values()
+        if chunks:
+            text = '{\n' + ',\n'.join(chunks) + '\n}'
+        else:
+            text = '{}'
+        self.writer.write(dst_path, text)
+        self.saved_path = dst_path
+
+        if wait:
+            self.writer.flush()
+
+    def load(self, path, strict=False):
+        '''
+        Loads the results from json filling the annotations of all clips at once.
+        Only the clips present in the current data are read, the others are kept as they are
+        and written back on saving (unless strict is set, then all the clips must be present)
+        '''
         assert self.clips
         loaded_data = json.load(open(path, 'r'))
 
+        clip_ids, frame_ids, annos = [], [], []
         for clip_name, loaded_clip in loaded_data.items():
-            found = False
-            for clip in self.clips:
-                if clip.name == clip_name:
-                    for frame_id, frame_annos in loaded_clip.items():
-                        frame_id = int(frame_id)
-                        pos = None
-                        if 'pos' in frame_annos:
-                            pos = frame_annos['pos']
-                        clip.annos[frame_id] = {'label': frame_annos['label'], 'pos': pos}
-                    found = True
-                    break
-            assert found
+            clip_id = self.name_to_idx_map.get(clip_name)
+            if clip_id is None:
+                assert not strict, 'Clip \'{}\' not found'.format(clip_name)
+                self.missing_clip_chunks[clip_name] = json.dumps({clip_name: loaded_clip}, indent=2)[2:-2]
+                continue
+            clip_ids += [clip_id] * len(loaded_clip)
+            frame_ids += loaded_clip.keys()
+            annos += loaded_clip.values()
+            self.dirty_clip_ids.add(clip_id)
+
+        if self.missing_clip_chunks:
+            print('Skipped {} clips not found in the data'.format(len(self.missing_clip_chunks)))
+        if not annos:
+            return
+
+        # Fill the annotations of all clips in one step:
+        clip_ids = np.array(clip_ids, dtype=np.int64)
+        frame_ids = np.array(frame_ids).astype(np.int64)
+        num_frames = np.diff(self.clip_offsets)[clip_ids]
+        assert frame_ids.min() >= 0 and np.all(frame_ids < num_frames)
+        idx = self.clip_offsets[clip_ids] + frame_ids
+        labels, positions, keyframes, interpolated = DPClip.annos_to_arrays(annos)
+
+        self.labels[idx] = labels
+        self.positions[idx] = positions
+        self.keyframes[idx] = keyframes
+        self.interpolated[idx] = interpolated
+
+    def restore(self, path):
+        ''' Replays the journal of the edits made in the previous (unexpectedly terminated) session '''
+        assert self.clips
+
+        with open(path, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    print('Skipping a damaged journal entry: {}'.format(line.strip()))
+                    continue
+                for clip_name, annos in entry.items():
+                    clip_id = self.name_to_idx_map.get(clip_name)
+                    if clip_id is None:
+                        print('Skipping unknown clip \'{}\''.format(clip_name))
+                        continue
+                    self.clips[clip_id].set_annos(annos)
+                    self.dirty_clip_ids.add(clip_id)
+
+    def close(self):
+        ''' Waits for the pending writes to finish and releases the videos '''
+        self.writer.close()
+        if self.decoder is not None:
+            self.decoder_pool.release(self.open_clip_id, self.decoder)
+            self.decoder = None
+        self.decoder_pool.close()
 
     @property
     def frame_pos(self):
@@ -131,14 +433,24 @@ class DataProcessor:
         return self.clips[self.current_clip_id].num_frames
 
     def _open_video(self):
+        # Keep the previous clip's decoder in the pool in case we come back to it:
+        if self.decoder is not None:
+            self.decoder_pool.release(self.open_clip_id, self.decoder)
+
         clip = self.clips[self.current_clip_id]
-        self.video_cap = cv2.VideoCapture(clip.path)
+        self.decoder = self.decoder_pool.acquire(self.current_clip_id, clip.path)
+        self.open_clip_id = self.current_clip_id
+
+    def _prefetch_adjacent_clips(self):
+        for clip_id in (self.current_clip_id + 1, self.current_clip_id - 1):
+            if 0 <= clip_id < len(self.clips):
+                clip = self.clips[clip_id]
+                self.decoder_pool.prefetch(clip_id, clip.path, clip.current_frame_id)
 
     def _read_frame(self):
-        assert self.video_cap
+        assert self.decoder
 
         clip = self.clips[self.current_clip_id]
-        self.video_cap.set(cv2.CAP_PROP_POS_FRAMES, clip.current_frame_id)
-        _, frame = self.video_cap.read()
+        frame = self.decoder.read(clip.current_frame_id)
 
         return frame
@@ -10,14 +10,21 @@ class FrameLayer:
 
     def draw(self, data):
         player_pos = data['player_pos']
+        anno_type = data['anno_type']
         self.canvas = data['image']
 
-        # Draw a new player position on the frame:n
+        # Draw a new player position on a copy of the frame (the decoded frame is cached):
         if player_pos is not None:
+            self.canvas = self.canvas.copy()
             x = int(round(player_pos[0] * self.size[0]))
             y = int(round(player_pos[1] * self.size[1]))
-            self.canvas = cv2.circle(self.canvas, (x, y), 7, color=(0, 0, 255), thickness=-1)
-            self.canvas = cv2.circle(self.canvas, (x, y), 5, color=(0, 255, 0), thickness=-1)
+            if anno_type == 'interpolated':
+                self.canvas = cv2.circle(self.canvas, (x, y), 5, color=(0, 255, 255), thickness=2)
+            else:
+                self.canvas = cv2.circle(self.canvas, (x, y), 7, color=(0, 0, 255), thickness=-1)
+                self.canvas = cv2.circle(self.canvas, (x, y), 5, color=(0, 255, 0), thickness=-1)
+            if anno_type == 'keyframe':
+                self.canvas = cv2.circle(self.canvas, (x, y), 11, color=(0, 255, 255), thickness=2)
 
         return self.canvas
 
@@ -37,6 +44,9 @@ class InfoLayer:
         next_clip_name = data['next_clip_name']
         frame_label  = data['frame_label']
         player_pos = data['player_pos']
+        anno_type = data['anno_type']
+        keyframe_mode = data['keyframe_mode']
+        interpolation = data['interpolation']
 
         self.canvas.fill(0)
 
@@ -87,6 +97,12 @@ class InfoLayer:
         if frame_label == True and player_pos is None:
             color = (128, 255, 128)
             text = 'true'
+        elif frame_label == True and player_pos is not None and anno_type == 'keyframe':
+            color = (128, 255, 255)
+            text = 'keyframe'
+        elif frame_label == True and player_pos is not None and anno_type == 'interpolated':
+            color = (255, 255, 128)
+            text = 'interpolated'
         elif frame_label == True and player_pos is not None:
             color = (255, 128, 128)
             text = 'edited'
@@ -98,6 +114,13 @@ class InfoLayer:
         UIRenderer.draw_text(self.canvas, text, (x+text_w, y), color, scale=1, lineType=2, font=self.font)
 
 
+        # Editing mode:
+        if keyframe_mode:
+            text = 'Keyframes ({})'.format(interpolation)
+            color = (128, 255, 255)
+            UIRenderer.draw_text(self.canvas, text, (x + 480, y), color, scale=1, lineType=2, font=self.font)
+
+
         # Saved:
         if self.saved_counter > 0:
             y = self.dh + 50
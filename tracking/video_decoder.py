@@ -0,0 +1,118 @@
+import cv2
+import queue
+import threading
+from collections import OrderedDict
+
+
+class VideoDecoder:
+    ''' Opened video clip that remembers its position to avoid unnecessary seeking '''
+
+    def __init__(self, path):
+        self.path = path
+        self.video_cap = cv2.VideoCapture(path)
+        self.next_frame_id = 0
+        self.frame_id = -1
+        self.frame = None
+
+    def read(self, frame_id):
+        ''' Returns the image of the frame (the returned image must not be modified) '''
+        if frame_id == self.frame_id:
+            return self.frame
+
+        # Seek only if the frame is not the next one:
+        if frame_id != self.next_frame_id:
+            self.video_cap.set(cv2.CAP_PROP_POS_FRAMES, frame_id)
+        _, self.frame = self.video_cap.read()
+        self.frame_id = frame_id
+        self.next_frame_id = frame_id + 1
+
+        return self.frame
+
+    def release(self):
+        self.video_cap.release()
+        self.frame = None
+
+
+class DecoderPool:
+    '''
+    Keeps a small LRU pool of opened video decoders.
+    The decoders of the clips that are likely to be opened next are prepared in a background thread:
+    the container is opened and the frame the clip will be resumed from is decoded in advance
+    '''
+
+    def __init__(self, max_size=4):
+        self.max_size = max_size
+        self.decoders = OrderedDict()   # clip_id -> VideoDecoder, the most recently used is the last
+        self.in_progress = set()
+        self.lock = threading.Condition()
+        self.tasks = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def prefetch(self, clip_id, path, frame_id):
+        ''' Schedules preparing of the clip's decoder '''
+        with self.lock:
+            if clip_id in self.decoders or clip_id in self.in_progress:
+                return
+            self.in_progress.add(clip_id)
+        self.tasks.put((clip_id, path, frame_id))
+
+    def acquire(self, clip_id, path):
+        ''' Takes the clip's decoder from the pool (or opens a new one) '''
+        with self.lock:
+            # Wait for the decoder if it is being prepared right now:
+            while clip_id in self.in_progress:
+                self.lock.wait()
+            decoder = self.decoders.pop(clip_id, None)
+
+        if decoder is None:
+            decoder = VideoDecoder(path)
+
+        return decoder
+
+    def release(self, clip_id, decoder):
+        ''' Returns the decoder to the pool (it stays open until evicted) '''
+        with self.lock:
+            self.decoders[clip_id] = decoder
+            self.decoders.move_to_end(clip_id)
+            self._evict()
+
+    def close(self):
+        self.tasks.put(None)
+        self.thread.join()
+        with self.lock:
+            for decoder in self.decoders.values():
+                decoder.release()
+            self.decoders.clear()
+
+    def _evict(self):
+        while len(self.decoders) > self.max_size:
+            _, decoder = self.decoders.popitem(last=False)
+            decoder.release()
+
+    def _run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            clip_id, path, frame_id = task
+
+            decoder = None
+            try:
+                decoder = VideoDecoder(path)
+                decoder.read(frame_id)
+            except Exception as e:
+                # acquire() will open the clip itself:
+                print('Cannot prepare the decoder of {}: {}'.format(path, str(e)))
+                if decoder is not None:
+                    decoder.release()
+                decoder = None
+            finally:
+                # The clip must leave in_progress anyway, otherwise acquire() would wait for it forever:
+                with self.lock:
+                    self.in_progress.discard(clip_id)
+                    if decoder is not None:
+                        self.decoders[clip_id] = decoder
+                        self.decoders.move_to_end(clip_id)
+                        self._evict()
+                    self.lock.notify_all()
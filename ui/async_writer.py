@@ -0,0 +1,82 @@
+import os
+import queue
+import threading
+
+
+class AsyncWriter:
+    '''
+    Writes files in a background thread so that the UI thread never waits for the disk.
+    Supports appending lines to a journal, atomically replacing whole files and
+    running arbitrary functions (in the order they were scheduled with the writes).
+    '''
+
+    def __init__(self):
+        self.tasks = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def append(self, path, text):
+        ''' Appends text to the end of the file '''
+        self.tasks.put(('append', path, text))
+
+    def write(self, path, text):
+        ''' Replaces the content of the file with text (via a temp file and rename) '''
+        self.tasks.put(('write', path, text))
+
+    def call(self, func, *args):
+        ''' Runs func(*args) in the writer thread '''
+        self.tasks.put(('call', func, args))
+
+    def flush(self):
+        ''' Blocks until all the scheduled writes are done '''
+        self.tasks.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.tasks.put(('close', None, None))
+            self.thread.join()
+
+    def _run(self):
+        pending = None
+        while True:
+            task = pending if pending is not None else self.tasks.get()
+            pending = None
+            mode, path, text = task
+            if mode == 'close':
+                self.tasks.task_done()
+                break
+            num_tasks = 1
+
+            # Merge the queued appends to the same file into a single write:
+            if mode == 'append':
+                chunks = [text]
+                while pending is None:
+                    try:
+                        next_task = self.tasks.get_nowait()
+                    except queue.Empty:
+                        break
+                    if next_task[0] == 'append' and next_task[1] == path:
+                        chunks.append(next_task[2])
+                        num_tasks += 1
+                    else:
+                        pending = next_task
+                text = ''.join(chunks)
+
+            try:
+                if mode == 'call':
+                    func, args = path, text
+                    func(*args)
+                elif mode == 'append':
+                    with open(path, 'a') as file:
+                        file.write(text)
+                else:
+                    temp_path = path + '.tmp'
+                    with open(temp_path, 'w') as file:
+                        file.write(text)
+                    os.replace(temp_path, path)
+            except Exception as e:
+                # The thread must survive any error, otherwise flush() and close() would block forever:
+                print('Cannot write: {}'.format(str(e)))
+            finally:
+                for _ in range(num_tasks):
+                    self.tasks.task_done()
@@ -0,0 +1,108 @@
+import os
+import re
+import json
+import shutil
+import threading
+
+
+MANIFEST_FILE_NAME = '.convert_manifest.json'
+PART_FILE_SUFFIX = '.part'
+PART_NAME_PATTERN = re.compile(r'^\..*' + re.escape(PART_FILE_SUFFIX) + r'\.(\d+)\.')  # pid of the run
+
+
+def get_fingerprint(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def get_part_path(dst_file):
+    '''
+    Temp path the output is written to until the conversion succeeds
+    (hidden, unique to the run, and with the same extension, so ffmpeg chooses the same container)
+    '''
+    dst_dir, name = os.path.split(dst_file)
+    stem, ext = os.path.splitext(name)
+    return os.path.join(dst_dir, '.{}{}.{}{}'.format(stem, PART_FILE_SUFFIX, os.getpid(), ext))
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to another user:
+        return True
+    return True
+
+
+def remove_stale_parts(dst_folder):
+    '''
+    Removes the temp outputs (and the concat temp dirs named after them) of the interrupted runs.
+    The ones of the runs that are still going are kept
+    '''
+    for name in os.listdir(dst_folder):
+        if not name.startswith('.') or PART_FILE_SUFFIX + '.' not in name:
+            continue
+        match = PART_NAME_PATTERN.match(name)
+        if match is not None and _is_running(int(match.group(1))):
+            continue
+        path = os.path.join(dst_folder, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.isfile(path):
+            os.remove(path)
+
+
+class ConvertManifest:
+    '''
+    Records of the outputs of dst_folder: fingerprints (path, size, mtime) of their sources,
+    the conversion params and the size / mtime of the output written by the conversion.
+    An output is up to date if none of them has changed since it was written
+    '''
+
+    def __init__(self, dst_folder):
+        self.path = os.path.join(dst_folder, MANIFEST_FILE_NAME)
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as file:
+                    self.entries = json.load(file)
+            except ValueError:
+                print('Ignoring the damaged manifest {}'.format(self.path))
+
+    def is_up_to_date(self, dst_file, src_files, params):
+        entry = self.entries.get(os.path.basename(dst_file))
+        if entry is None or entry['params'] != params or not os.path.isfile(dst_file):
+            return False
+        try:
+            sources = [get_fingerprint(src) for src in src_files]
+        except OSError:
+            return False
+        stat = os.stat(dst_file)
+
+        return entry['sources'] == sources and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns
+
+    def record(self, dst_file, src_files, params):
+        ''' Records the output that has just been written and saves the manifest '''
+        stat = os.stat(dst_file)
+        entry = {
+            'sources': [get_fingerprint(src) for src in src_files],
+            'params': params,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns
+        }
+        with self.lock:
+            # Another run into the same folder may have recorded its outputs meanwhile:
+            if os.path.isfile(self.path):
+                try:
+                    with open(self.path, 'r') as file:
+                        self.entries.update(json.load(file))
+                except ValueError:
+                    pass
+            self.entries[os.path.basename(dst_file)] = entry
+            temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(temp_path, 'w') as file:
+                json.dump(self.entries, file, indent=2)
+            os.replace(temp_path, self.path)
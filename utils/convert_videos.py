@@ -1,14 +1,19 @@
 import argparse
 import os
-import subprocess
+import sys
 from datetime import datetime
-from subprocess import check_output
 import json
+import tempfile
+
+from ffmpeg_jobs import FFmpegJob, JobScheduler, DEFAULT_THREADS_PER_JOB
+from video_info import get_default_cache
+from convert_manifest import ConvertManifest, get_part_path, remove_stale_parts
 
 
 TEMPLATE_FILE_SUFFIX = '_template.txt'
 MAX_VIDEO_BITRATE = 3500000
 TARGET_VIDEO_HEIGHT = 720
+REPORT_FILE_NAME = 'convert_report.json'
 
 
 def change_ext(name, new_ext):
@@ -17,62 +22,105 @@ def change_ext(name, new_ext):
 
 
 def get_video_info(src, verbose=False):
-    cmd = 'ffprobe -loglevel 0 -print_format json -show_format -show_streams ' + src
-    out = check_output(cmd.split()).decode("utf-8")
-    info = json.loads(out)
+    ''' ffprobe info of the video (cached, see VideoInfoCache) '''
+    info = get_default_cache().get(src)
     if verbose:
-        print (out)
+        print (json.dumps(info, indent=2))
 
     return info
 
 
-def run_ffmpeg(src, dst, params):
-    if src is not None:
-        cmd = ['ffmpeg', '-i', src]
-    else:
-        cmd = ['ffmpeg']
-    params = params.split()
-    if len(params):
-        cmd += params
-    cmd += [dst]
-    print(' '.join(cmd))
-    subprocess.Popen(cmd).wait()
+def run_video_concat_with_ffmpeg(src_files, dst_file, target_fps=None, preset='medium', scale_720=False, max_bitrate=None):
+    scheduler = JobScheduler()
+    scheduler.add(make_concat_job(src_files, dst_file, target_fps, preset, scale_720, max_bitrate))
+    scheduler.run()
 
 
-def run_video_concat_with_ffmpeg(src_files, dst_file, target_fps=None, preset='medium', scale_720=False, max_bitrate=None):
-    # convert to temp files of same parameters
-    temp_names = []
-    for i, name in enumerate(src_files):
-        temp_name = "temp{}.mp4".format(i+1)
-        run_video_with_ffmpeg(name, temp_name, target_fps=target_fps, preset=preset, scale_720=scale_720, max_bitrate=max_bitrate)
-        temp_names.append(temp_name)
+def get_stream_params(info):
+    ''' Parameters the parts must share to be concatenated without re-encoding '''
+    keys = {
+        'video': ('codec_name', 'profile', 'width', 'height', 'pix_fmt', 'r_frame_rate', 'time_base'),
+        'audio': ('codec_name', 'sample_rate', 'channels')
+    }
+    return [(stream['codec_type'],) + tuple(stream.get(key) for key in keys[stream['codec_type']])
+            for stream in info['streams'] if stream['codec_type'] in keys]
 
-    # make temporary concat.txt for merging clips
-    file = open("concat.txt", "w")
-    for name in temp_names:
-        file.write('file ' + name + '\n')
-    file.close()
 
-    # convert to a single file
-    params = "-f concat -safe 0 -i concat.txt -c copy"
-    run_ffmpeg(None, dst_file, params)
+def get_concat_filter_params(infos, target_fps=None, preset='medium', scale_720=False):
+    '''
+    Params of a single ffmpeg run that normalizes the parts (size, fps, pixel format, audio format)
+    and joins them with the concat filter
+    '''
+    video = [next(s for s in info['streams'] if s['codec_type'] == 'video') for info in infos]
+    has_audio = all(any(s['codec_type'] == 'audio' for s in info['streams']) for info in infos)
+
+    # The parts are fitted into the size of the first one:
+    height = TARGET_VIDEO_HEIGHT if scale_720 else int(video[0]['height'])
+    width = int(round(int(video[0]['width']) * height / int(video[0]['height']) / 2)) * 2
+    fps = target_fps if target_fps is not None else video[0].get('r_frame_rate', '25/1')
+
+    filters, inputs = [], ''
+    for i in range(len(infos)):
+        filters.append('[{i}:v]scale={w}:{h}:force_original_aspect_ratio=decrease,'
+                       'pad={w}:{h}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={fps},format=yuv420p[v{i}]'.format(
+                        i=i, w=width, h=height, fps=fps))
+        inputs += '[v{}]'.format(i)
+        if has_audio:
+            filters.append('[{i}:a]aresample=48000,aformat=channel_layouts=stereo[a{i}]'.format(i=i))
+            inputs += '[a{}]'.format(i)
+    filters.append('{}concat=n={}:v=1:a={}{}'.format(inputs, len(infos), int(has_audio), '[v][a]' if has_audio else '[v]'))
+
+    params = ['-filter_complex', ';'.join(filters), '-map', '[v]', '-codec:v', 'libx264']
+    params += ['-map', '[a]', '-codec:a', 'aac'] if has_audio else ['-an']
+    if preset != 'medium':
+        params += ['-preset', preset]
 
-    # remove temp files
-    for name in temp_names:
-        os.remove(name)
-    os.remove("concat.txt")
+    return params
 
 
-def run_video_with_ffmpeg(src_file, dst_file, target_fps=None, preset='medium', scale_720=False, max_bitrate=None):
+def make_concat_job(src_files, dst_file, target_fps=None, preset='medium', scale_720=False, max_bitrate=None):
     '''
-    :param src_file:   Source video path
-    :param dst_file:   Destination video path
-    :param target_fps: Target FPS
-    :param preset:     Encoding speed (ultrafast, superfast, veryfast, faster, fast,
-                                       medium (the default), slow, slower, veryslow)
-    :param scale_720:  Scale to 720 pixels in height, and automatically choose width
+    Joins the parts into dst_file in a single ffmpeg run: if the parts can be stream copied and share
+    the codec params, they are concatenated without re-encoding, otherwise they are normalized and joined
+    with the concat filter. The temp files go to a unique directory next to dst_file
+    '''
+    infos = [get_video_info(name) for name in src_files]
+    parts = [get_video_params(name, target_fps, preset, scale_720, max_bitrate) for name in src_files]
+    durations = [duration for _, _, duration in parts]
+    duration = sum(durations) if None not in durations else None
+
+    stream_copy = all(part_copy for _, part_copy, _ in parts) and \
+        all(get_stream_params(info) == get_stream_params(infos[0]) for info in infos)
+    if stream_copy:
+        temp_dir = tempfile.mkdtemp(prefix='.{}.'.format(os.path.basename(dst_file)),
+                                    dir=os.path.dirname(os.path.abspath(dst_file)))
+        concat_path = os.path.join(temp_dir, 'concat.txt')
+        with open(concat_path, 'w') as file:
+            for name in src_files:
+                file.write('file \'{}\'\n'.format(os.path.abspath(name).replace('\'', '\'\\\'\'')))
+        cmd = ['-f', 'concat', '-safe', '0', '-i', concat_path, '-c:v', 'copy']
+        # The audio is copied only if it's AAC (the bitstream filter supports only AAC), otherwise it's encoded:
+        audio_codecs = [stream.get('codec_name') for stream in infos[0]['streams'] if stream['codec_type'] == 'audio']
+        if audio_codecs and all(codec == 'aac' for codec in audio_codecs):
+            cmd += ['-c:a', 'copy', '-bsf:a', 'aac_adtstoasc']
+        elif audio_codecs:
+            cmd += ['-c:a', 'aac']
+        cmd += [dst_file]
+        cleanup = [temp_dir]
+    else:
+        cmd = []
+        for name in src_files:
+            cmd += ['-i', name]
+        cmd += get_concat_filter_params(infos, target_fps, preset, scale_720) + [dst_file]
+        cleanup = []
 
-    see more: https://askubuntu.com/questions/352920/fastest-way-to-convert-videos-batch-or-single
+    return FFmpegJob(os.path.basename(dst_file), [cmd], duration, stream_copy, cleanup)
+
+
+def get_video_params(src_file, target_fps=None, preset='medium', scale_720=False, max_bitrate=None):
+    '''
+    Chooses the ffmpeg params of the conversion (see run_video_with_ffmpeg()).
+    Returns the params, whether the video is just stream copied and the duration of the video
     '''
     if max_bitrate is None:
         max_bitrate = MAX_VIDEO_BITRATE
@@ -81,6 +129,7 @@ def run_video_with_ffmpeg(src_file, dst_file, target_fps=None, preset='medium',
 
     # Get container info:
     format = info['format']['format_name']
+    duration = float(info['format']['duration']) if 'duration' in info['format'] else None
 
     # Get video codec info:
     v_codec, v_start_time, v_bit_rate, v_pix_fmt, v_height = None, None, None, None, None
@@ -139,8 +188,29 @@ def run_video_with_ffmpeg(src_file, dst_file, target_fps=None, preset='medium',
     if preset != 'medium':
         params += ' -preset {}'.format(preset)
 
-    # Run ffmpeg:
-    run_ffmpeg(src_file, dst_file, params)
+    return params, params.startswith(' -c:v copy'), duration
+
+
+def make_video_job(src_file, dst_file, target_fps=None, preset='medium', scale_720=False, max_bitrate=None):
+    params, stream_copy, duration = get_video_params(src_file, target_fps, preset, scale_720, max_bitrate)
+    return FFmpegJob(os.path.basename(dst_file), [['-i', src_file] + params.split() + [dst_file]],
+                     duration, stream_copy)
+
+
+def run_video_with_ffmpeg(src_file, dst_file, target_fps=None, preset='medium', scale_720=False, max_bitrate=None):
+    '''
+    :param src_file:   Source video path
+    :param dst_file:   Destination video path
+    :param target_fps: Target FPS
+    :param preset:     Encoding speed (ultrafast, superfast, veryfast, faster, fast,
+                                       medium (the default), slow, slower, veryslow)
+    :param scale_720:  Scale to 720 pixels in height, and automatically choose width
+
+    see more: https://askubuntu.com/questions/352920/fastest-way-to-convert-videos-batch-or-single
+    '''
+    scheduler = JobScheduler()
+    scheduler.add(make_video_job(src_file, dst_file, target_fps, preset, scale_720, max_bitrate))
+    scheduler.run()
 
 
 def sort_by_name(names):
@@ -158,7 +228,38 @@ def sort_by_name(names):
     return sorted_sorted_names
 
 
-def main(src_folder, dst_folder, preset='medium', max_bitrate=None, scale_720=False, dst_format='.mp4'):
+def write_atomically(job, dst_file, src_files, params, manifest):
+    '''
+    Makes the job write to a temp file that replaces dst_file only when the job succeeds
+    (so an interrupted run does not leave a truncated output) and records the output in the manifest
+    '''
+    part_file = job.cmds[-1][-1]
+
+    def on_success():
+        try:
+            os.replace(part_file, dst_file)
+        except FileNotFoundError:
+            # (the job fails with this error instead of a bare one)
+            raise FileNotFoundError('The output {} has been removed before it was renamed to {}'.format(
+                part_file, dst_file))
+        manifest.record(dst_file, src_files, params)
+
+    job.name = os.path.basename(dst_file)
+    job.cleanup.append(part_file)
+    job.on_success = on_success
+
+    return job
+
+
+def main(src_folder, dst_folder, preset='medium', max_bitrate=None, scale_720=False, dst_format='.mp4',
+         cpu_budget=None, threads_per_job=DEFAULT_THREADS_PER_JOB, force=False, report_path=None):
+    '''
+    Converts all the games of src_folder by parallel ffmpeg jobs (see JobScheduler).
+    The games that have already been converted with the same params from the same sources
+    are skipped (see ConvertManifest), unless force is set.
+    The metrics of the jobs are written to report_path (dst_folder/convert_report.json by default).
+    Returns the failed jobs
+    '''
 
     start_time = datetime.now()
 
@@ -171,26 +272,52 @@ def main(src_folder, dst_folder, preset='medium', max_bitrate=None, scale_720=Fa
     if not os.path.exists(dst_folder):
         os.makedirs(dst_folder)
 
-    results = []
-    # convert single file games
-    for name in single_src_files:
-        src = os.path.join(src_folder, name)
-        dst = os.path.join(dst_folder, change_ext(name, dst_format))
+    # Remove the outputs (and the concat temp dirs) of the interrupted runs:
+    remove_stale_parts(dst_folder)
+
+    # Probe all the sources at once (only the new / changed ones are actually probed):
+    get_default_cache().prefetch([os.path.join(src_folder, name) for name in src_files])
+
+    manifest = ConvertManifest(dst_folder)
+    params = {
+        'preset': preset,
+        'max_bitrate': max_bitrate if max_bitrate is not None else MAX_VIDEO_BITRATE,
+        'scale_720': scale_720,
+        'target_fps': None
+    }
+    games = [([os.path.join(src_folder, name)], os.path.join(dst_folder, change_ext(name, dst_format)))
+             for name in single_src_files]
+    games += [([os.path.join(src_folder, name) for name in sources], os.path.join(dst_folder, base_name + dst_format))
+              for base_name, sources in multiple_files.items()]
+
+    scheduler = JobScheduler(cpu_budget, threads_per_job)
+    num_skipped = 0
+    for sources, dst in games:
         dst = dst.replace('_orig', '')
-        run_video_with_ffmpeg(src, dst, preset=preset, scale_720=scale_720, max_bitrate=max_bitrate)
-        results.append(dst)
-
-    # convert games recorded in multiple files
-    for base_name, sources in multiple_files.items():
-        sources = [os.path.join(src_folder, name) for name in sources]
-        dst = os.path.join(dst_folder, base_name + dst_format)
-        dst = dst.replace('_orig', '')
-        run_video_concat_with_ffmpeg(sources, dst, preset=preset, scale_720=scale_720, max_bitrate=max_bitrate)
-        results.append(dst)
+        if not force and manifest.is_up_to_date(dst, sources, params):
+            num_skipped += 1
+            continue
+        if len(sources) == 1:
+            # convert single file games
+            job = make_video_job(sources[0], get_part_path(dst), preset=preset, scale_720=scale_720,
+                                 max_bitrate=max_bitrate)
+        else:
+            # convert games recorded in multiple files
+            job = make_concat_job(sources, get_part_path(dst), preset=preset, scale_720=scale_720,
+                                  max_bitrate=max_bitrate)
+        scheduler.add(write_atomically(job, dst, sources, params, manifest))
+    if num_skipped:
+        print('Skipped {} games converted by the previous runs'.format(num_skipped))
+
+    if report_path is None:
+        report_path = os.path.join(dst_folder, REPORT_FILE_NAME)
+    failed = scheduler.run(report_path)
 
     end_time = datetime.now()
     print(f'Time elapsed: {end_time - start_time}')
 
+    return failed
+
 
 def parse_args():
     parser = argparse.ArgumentParser("Tool to run source video(-s) with ffmpeg based converter")
@@ -204,10 +331,23 @@ def parse_args():
                         help='Max video bitrate above which re-encoding will be performed')
     parser.add_argument('-p', '--preset', type=str, default='medium',
                         help='Encoding speed (see run_video_with_ffmpeg() function for details)')
+    parser.add_argument('-c', '--cpu_budget', type=int, default=None,
+                        help='Number of threads all the encoding jobs may use together (all CPUs by default)')
+    parser.add_argument('-t', '--threads_per_job', type=int, default=DEFAULT_THREADS_PER_JOB,
+                        help='Number of threads of a single encoding job')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Convert all the games, even those converted by the previous runs')
+    parser.add_argument('-r', '--report', default=None,
+                        help='Json or csv file of the metrics of the jobs (destination_video_folder/{} '
+                             'by default)'.format(REPORT_FILE_NAME))
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parse_args()
-    main(args.source_video_folder, args.destination_video_folder,
-         preset=args.preset, max_bitrate=args.max_bitrate, scale_720=args.scale_720)
\ No newline at end of file
+    failed = main(args.source_video_folder, args.destination_video_folder,
+                  preset=args.preset, max_bitrate=args.max_bitrate, scale_720=args.scale_720,
+                  cpu_budget=args.cpu_budget, threads_per_job=args.threads_per_job, force=args.force,
+                  report_path=args.report)
+    if failed:
+        sys.exit(1)
\ No newline at end of file
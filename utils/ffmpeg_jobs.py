@@ -0,0 +1,225 @@
+import os
+import csv
+import json
+import shutil
+import threading
+import subprocess
+from collections import deque
+from datetime import datetime
+from timeit import default_timer as timer
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_THREADS_PER_JOB = 4
+PROGRESS_PRINT_STEP = 10    # percent
+REPORT_FIELDS = ('name', 'returncode', 'stream_copy', 'duration', 'elapsed', 'cpu_time', 'speed', 'fps',
+                 'bitrate', 'total_size', 'frames', 'out_time')
+
+
+class FFmpegJob:
+    '''
+    One output produced by one or several sequential ffmpeg runs (e.g. the parts of a game and their concat).
+    stream_copy jobs do not encode anything, so they are not limited by the CPU budget
+    '''
+
+    def __init__(self, name, cmds, duration=None, stream_copy=False, cleanup=None, on_success=None):
+        '''
+        :param cmds:       ffmpeg arguments (without 'ffmpeg' itself) of the runs
+        :param duration:   Duration of the processed media in seconds (for the ordering and the progress)
+        :param cleanup:    Paths of the temp files / directories to remove when the job is finished
+        :param on_success: Function called (before the cleanup) when all the runs have succeeded
+        '''
+        self.name = name
+        self.cmds = cmds
+        self.duration = duration
+        self.stream_copy = stream_copy
+        self.cleanup = cleanup if cleanup is not None else []
+        self.on_success = on_success
+        self.returncode = None
+        self.errors = deque(maxlen=20)   # the last lines ffmpeg has written to stderr
+        self.elapsed = None
+        # Totals of the runs (from the -progress reports of ffmpeg and the resource usage of the processes):
+        self.cpu_time = 0.0     # user + system, seconds
+        self.total_size = 0     # bytes written
+        self.frames = 0
+        self.out_time = 0.0     # seconds of the media written
+
+    @property
+    def failed(self):
+        return self.returncode != 0
+
+    @property
+    def speed(self):
+        ''' Seconds of the media processed per second (as ffmpeg's speed=) '''
+        return self.out_time / self.elapsed if self.elapsed else None
+
+    @property
+    def fps(self):
+        return self.frames / self.elapsed if self.elapsed else None
+
+    @property
+    def bitrate(self):
+        ''' Bitrate of the output, bits/s '''
+        return self.total_size * 8 / self.out_time if self.out_time else None
+
+    def get_metrics(self):
+        metrics = {field: getattr(self, field) for field in REPORT_FIELDS}
+        return {key: round(value, 3) if isinstance(value, float) else value for key, value in metrics.items()}
+
+
+def _parse_int(value):
+    ''' ffmpeg reports N/A for the values it does not know yet '''
+    return int(value) if value is not None and value.isdigit() else 0
+
+
+def _read_lines(stream, lines):
+    for line in stream:
+        lines.append(line.rstrip())
+
+
+class JobScheduler:
+    '''
+    Runs ffmpeg jobs in parallel: the encoding jobs take threads_per_job threads (passed to ffmpeg with
+    -threads) out of the cpu_budget, the stream copy jobs run besides them.
+    The longest jobs are started first, so the batch does not end with a single long job running
+    '''
+
+    def __init__(self, cpu_budget=None, threads_per_job=DEFAULT_THREADS_PER_JOB, max_copy_jobs=2, print_steps=True):
+        self.cpu_budget = cpu_budget if cpu_budget is not None else os.cpu_count()
+        self.threads_per_job = max(min(threads_per_job, self.cpu_budget), 1)
+        self.max_encode_jobs = max(self.cpu_budget // self.threads_per_job, 1)
+        self.max_copy_jobs = max_copy_jobs
+        self.print_steps = print_steps
+        self.jobs = []
+        self.print_lock = threading.Lock()
+
+    def add(self, job):
+        self.jobs.append(job)
+
+    def run(self, report_path=None):
+        '''
+        Runs all the jobs and returns the failed ones.
+        The metrics of the jobs are written to report_path (json or csv, see write_report()),
+        unless there are no jobs (so the report of the previous run is kept)
+        '''
+        jobs = sorted(self.jobs, key=lambda j: j.duration if j.duration is not None else 0, reverse=True)
+        self._print('Running {} jobs: {} encoding at once ({} threads each), {} stream copy at once'.format(
+            len(jobs), self.max_encode_jobs, self.threads_per_job, self.max_copy_jobs))
+
+        with ThreadPoolExecutor(max_workers=self.max_encode_jobs) as encode_pool, \
+                ThreadPoolExecutor(max_workers=self.max_copy_jobs) as copy_pool:
+            futures = [(copy_pool if job.stream_copy else encode_pool).submit(self._run_job, job) for job in jobs]
+            for future in futures:
+                future.result()
+
+        failed = [job for job in jobs if job.failed]
+        self._print_summary(jobs, failed)
+        if report_path is not None and jobs:
+            write_report(jobs, report_path)
+
+        return failed
+
+    def _run_job(self, job):
+        start = timer()
+        self._print('[{}] started'.format(job.name))
+        try:
+            for i, cmd in enumerate(job.cmds):
+                if self.print_steps and len(job.cmds) > 1:
+                    self._print('[{}] step {}/{}'.format(job.name, i + 1, len(job.cmds)))
+                job.returncode = self._run_ffmpeg(job, cmd)
+                if job.returncode != 0:
+                    break
+            if job.returncode == 0 and job.on_success is not None:
+                job.on_success()
+        except OSError as e:
+            job.returncode = -1
+            job.errors.append(str(e))
+        finally:
+            for path in job.cleanup:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif os.path.isfile(path):
+                    os.remove(path)
+        job.elapsed = timer() - start
+
+        if job.failed:
+            self._print('[{}] FAILED with code {}'.format(job.name, job.returncode))
+        else:
+            self._print('[{}] done in {:.0f}s'.format(job.name, job.elapsed))
+
+    def _run_ffmpeg(self, job, cmd):
+        if not job.stream_copy:
+            # -threads is an output option, so it goes right before the output path:
+            cmd = cmd[:-1] + ['-threads', str(self.threads_per_job), cmd[-1]]
+        cmd = ['ffmpeg', '-y', '-nostdin', '-loglevel', 'error', '-nostats', '-progress', 'pipe:1'] + cmd
+
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        stderr_reader = threading.Thread(target=_read_lines, args=(proc.stderr, job.errors), daemon=True)
+        stderr_reader.start()
+
+        # ffmpeg reports the progress as blocks of key=value lines ending with progress=
+        # (the percentage is known only if the job is a single run):
+        next_percent = PROGRESS_PRINT_STEP
+        block, last_block = {}, None
+        for line in proc.stdout:
+            key, _, value = line.strip().partition('=')
+            block[key] = value
+            if key != 'progress':
+                continue
+            out_time_us = block.get('out_time_us', '')
+            if job.duration and len(job.cmds) == 1 and out_time_us.isdigit():
+                percent = min(100.0 * int(out_time_us) / 1e6 / job.duration, 100.0)
+                if percent >= next_percent:
+                    self._print('[{}] {:.0f}% (speed {}, {} fps)'.format(
+                        job.name, percent, block.get('speed', 'N/A').strip(), block.get('fps', 'N/A')))
+                    next_percent = (percent // PROGRESS_PRINT_STEP + 1) * PROGRESS_PRINT_STEP
+                    if percent >= 100:
+                        next_percent = float('inf')
+            last_block, block = block, {}
+
+        # The process is waited with wait4() to get its CPU time:
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        stderr_reader.join()
+        proc.stdout.close()
+        proc.stderr.close()
+
+        job.cpu_time += rusage.ru_utime + rusage.ru_stime
+        if last_block is not None:
+            job.total_size += _parse_int(last_block.get('total_size'))
+            job.frames += _parse_int(last_block.get('frame'))
+            job.out_time += _parse_int(last_block.get('out_time_us')) / 1e6
+
+        return proc.returncode
+
+    def _print(self, text):
+        with self.print_lock:
+            print('{} {}'.format(datetime.now().strftime('%H:%M:%S'), text), flush=True)
+
+    def _print_summary(self, jobs, failed):
+        self._print('Finished: {} jobs, {} failed'.format(len(jobs), len(failed)))
+        elapsed = sum(job.elapsed for job in jobs if job.elapsed is not None)
+        if elapsed > 0:
+            print('Jobs time: {:.0f}s, CPU time: {:.0f}s, media: {:.0f}s (speed {:.2f}x per job), written {:.1f} MB'.format(
+                elapsed, sum(job.cpu_time for job in jobs), sum(job.out_time for job in jobs),
+                sum(job.out_time for job in jobs) / elapsed, sum(job.total_size for job in jobs) / 1e6))
+        for job in failed:
+            print('FAILED: {} (code {})'.format(job.name, job.returncode))
+            for line in job.errors:
+                print('    ' + line)
+
+
+def write_report(jobs, path):
+    ''' Writes the metrics of the jobs to a csv file if the path ends with .csv, otherwise to a json file '''
+    rows = [job.get_metrics() for job in jobs]
+    report_dir = os.path.dirname(path)
+    if report_dir and not os.path.exists(report_dir):
+        os.makedirs(report_dir)
+    with open(path, 'w', newline='') as file:
+        if path.endswith('.csv'):
+            writer = csv.DictWriter(file, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            json.dump(rows, file, indent=2)
+    print('Report: {}'.format(path))
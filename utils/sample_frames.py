@@ -0,0 +1,140 @@
+import argparse
+import os
+import sys
+import json
+from datetime import datetime
+
+from ffmpeg_jobs import FFmpegJob, JobScheduler
+from video_info import get_default_cache
+
+
+MANIFEST_FILE_NAME = 'frames_manifest.json'
+REPORT_FILE_NAME = 'frames_report.json'
+FRAME_FORMATS = ('jpeg', 'webp')
+
+
+def parse_time(text):
+    ''' Converts 'HH:MM:SS.f' (or 'MM:SS.f', 'SS.f') to seconds '''
+    seconds = 0.0
+    for part in text.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def get_timestamps(start, stop, num_frames):
+    ''' Timestamps (in seconds) of num_frames frames evenly spaced in [start, stop) '''
+    step = (stop - start) / num_frames
+    return [start + i * step for i in range(num_frames)]
+
+
+def get_quality_params(frame_format, quality):
+    '''
+    Encoder params of the frames for the quality in [0, 100]
+    (for jpeg it's mapped to -q:v in [31, 2], the lower the better)
+    '''
+    assert frame_format in FRAME_FORMATS, 'Unknown frame format {}'.format(frame_format)
+    if frame_format == 'webp':
+        return ['-c:v', 'libwebp', '-quality', str(quality)]
+    return ['-q:v', str(int(round(2 + (100 - quality) * 29 / 100)))]
+
+
+def make_frame_cmd(src_path, timestamp, dst_path, quality_params):
+    '''
+    -ss before -i seeks the input to the keyframe before the timestamp, and only the frames
+    from the keyframe up to the timestamp are decoded (accurate seek)
+    '''
+    return ['-ss', '{:.3f}'.format(timestamp), '-i', src_path, '-frames:v', '1', '-an'] + quality_params + [dst_path]
+
+
+def sample_game_frames(src_path, dst_dir, start, stop, num_frames, frame_format='jpeg', quality=100,
+                       chunk_size=10):
+    '''
+    Makes the jobs that extract num_frames frames evenly spaced between start and stop (in seconds)
+    into dst_dir. Returns the jobs and the (timestamp, frame path) of the frames
+    '''
+    assert stop > start, 'Wrong time range of {}: {} - {}'.format(src_path, start, stop)
+
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    quality_params = get_quality_params(frame_format, quality)
+    frames = [(t, os.path.join(dst_dir, 'img-{:05d}.{}'.format(i + 1, frame_format)))
+              for i, t in enumerate(get_timestamps(start, stop, num_frames))]
+
+    # The frames are extracted by chunks, so the chunks of a game run in parallel:
+    name = os.path.basename(dst_dir)
+    jobs = []
+    for i in range(0, len(frames), chunk_size):
+        cmds = [make_frame_cmd(src_path, t, path, quality_params) for t, path in frames[i:i + chunk_size]]
+        jobs.append(FFmpegJob('{} {}-{}'.format(name, i + 1, i + len(cmds)), cmds))
+
+    return jobs, frames
+
+
+def sample_frames(games, video_dir, frames_dir, frame_format='jpeg', quality=100, num_workers=None,
+                  report_path=None):
+    '''
+    Extracts the frames of the games in parallel ffmpeg processes and writes the manifest of every game
+    to its frames folder. The metrics of the jobs are written to report_path (frames_dir/frames_report.json
+    by default).
+    :param games: (game, start, stop, number of frames); the video of the game is video_dir/game/game.mp4,
+                  stop=None - the end of the video
+    :return: {game: [(timestamp, frame path)]} of the extracted frames
+    '''
+    start_time = datetime.now()
+
+    src_paths = [os.path.join(video_dir, game, game + '.mp4') for game, _, _, _ in games]
+    get_default_cache().prefetch(src_paths)
+
+    # Decoding a single frame does not need many threads:
+    scheduler = JobScheduler(num_workers, threads_per_job=1, print_steps=False)
+    game_frames = []
+    for (game, start, stop, num_frames), src_path in zip(games, src_paths):
+        duration = get_default_cache().get(src_path)['format'].get('duration')
+        if duration is not None and (stop is None or stop > float(duration)):
+            stop = float(duration)
+        jobs, frames = sample_game_frames(src_path, os.path.join(frames_dir, game), start, stop, num_frames,
+                                          frame_format, quality)
+        for job in jobs:
+            scheduler.add(job)
+        game_frames.append((game, src_path, start, stop, frames))
+    scheduler.run(report_path if report_path is not None else os.path.join(frames_dir, REPORT_FILE_NAME))
+
+    manifests = {}
+    for game, src_path, start, stop, frames in game_frames:
+        frames = [(t, path) for t, path in frames if os.path.isfile(path)]
+        manifest = {'video': src_path, 'start': start, 'stop': stop, 'format': frame_format, 'quality': quality,
+                    'frames': frames}
+        with open(os.path.join(frames_dir, game, MANIFEST_FILE_NAME), 'w') as file:
+            json.dump(manifest, file, indent=2)
+        manifests[game] = frames
+        print('{}: {} frames'.format(game, len(frames)))
+
+    print(f'Time elapsed: {datetime.now() - start_time}')
+
+    return manifests
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Extracts frames evenly spaced in the time ranges of the games')
+    parser.add_argument('video_dir', help='Folder with the games (video_dir/game/game.mp4)')
+    parser.add_argument('frames_dir', help='Folder where to save the frames of the games (frames_dir/game/)')
+    parser.add_argument('-g', '--game', nargs=4, action='append', required=True,
+                        metavar=('NAME', 'START', 'STOP', 'NUM_FRAMES'),
+                        help='Game and its time range (HH:MM:SS.f), can be repeated')
+    parser.add_argument('-f', '--format', choices=FRAME_FORMATS, default='jpeg', help='Format of the frames')
+    parser.add_argument('-q', '--quality', type=int, default=100, help='Quality of the frames (0-100)')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of ffmpeg processes (all CPUs by default)')
+    parser.add_argument('-r', '--report', default=None,
+                        help='Json or csv file of the metrics of the jobs (frames_dir/{} by default)'.format(
+                            REPORT_FILE_NAME))
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    games = [(name, parse_time(start), parse_time(stop), int(num)) for name, start, stop, num in args.game]
+    manifests = sample_frames(games, args.video_dir, args.frames_dir, args.format, args.quality, args.workers,
+                              args.report)
+    if sum(len(frames) for frames in manifests.values()) < sum(num for _, _, _, num in games):
+        sys.exit(1)
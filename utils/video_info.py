@@ -0,0 +1,92 @@
+import os
+import json
+import threading
+from subprocess import check_output
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'sports-anno-tools', 'ffprobe.json')
+
+
+def probe_video(src):
+    ''' Runs ffprobe and returns the parsed format and streams info '''
+    cmd = ['ffprobe', '-loglevel', '0', '-print_format', 'json', '-show_format', '-show_streams', src]
+    out = check_output(cmd).decode("utf-8")
+
+    return json.loads(out)
+
+
+class VideoInfoCache:
+    '''
+    Persistent cache of the ffprobe info of the videos keyed by (path, size, mtime),
+    so a video is probed again only when it has changed
+    '''
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = path
+        self.entries = {}
+        self.changed = False
+        self.lock = threading.Lock()
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as file:
+                    self.entries = json.load(file)
+            except ValueError:
+                print('Ignoring the damaged video info cache {}'.format(path))
+
+    def get(self, src):
+        ''' Returns the info of the video probing it if it's not in the cache or has changed '''
+        key, stat = self._get_key(src)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['info']
+
+        info = probe_video(src)
+        with self.lock:
+            self.entries[key] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'info': info}
+            self.changed = True
+
+        return info
+
+    def prefetch(self, paths, num_workers=8):
+        ''' Probes the videos that are not in the cache in parallel and saves the cache '''
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            for path, error in zip(paths, pool.map(self._try_get, paths)):
+                if error is not None:
+                    print('Cannot probe {}: {}'.format(path, error))
+        self.save()
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            cache_dir = os.path.dirname(self.path)
+            if cache_dir and not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(temp_path, 'w') as file:
+                json.dump(self.entries, file)
+            os.replace(temp_path, self.path)
+            self.changed = False
+
+    def _try_get(self, src):
+        try:
+            self.get(src)
+        except Exception as e:
+            return str(e)
+        return None
+
+    @staticmethod
+    def _get_key(src):
+        return os.path.abspath(src), os.stat(src)
+
+
+_default_cache = None
+
+def get_default_cache():
+    ''' The cache shared by the video tools of the process '''
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = VideoInfoCache()
+    return _default_cache